@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+import argparse
+import datetime
+import json
+import logging
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# there are no speakers, and the benchmark doesn't beep
+sys.modules.setdefault("beepy", types.SimpleNamespace(beep=lambda sound=None: None))
+
+import cardsim
+import exifread
+import ezexif
+import ezhistory
+import ezingest
+import ezjournal
+import eznotify
+import ezretry
+import ezshare
+import ezupload
+
+
+#throughput of ezshare.py against a simulated card (see cardsim.py), for cards
+#of different sizes; every run is appended to this file, so regressions show
+#up when comparing runs over time
+_RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.jsonl")
+
+#the cost of notifying is measured over this many files at most
+_NOTIFICATIONS = 1000
+
+#dating is measured over this many shots at most, each a JPEG and a raw file
+#with Exif data like a camera's (see cardsim.make_exif())
+_SHOTS = 500
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ezshare.py against a simulated card")
+    parser.add_argument("--sizes", default="10,100,1000,10000", help="comma separated numbers of files on the card")
+    parser.add_argument("--file-size", type=int, default=64 * 1024, help="bytes per file")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second of the card")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="fraction of transfers cut off halfway")
+    parser.add_argument("--workers", type=int, default=ezshare._WORKERS, help="parallel downloads")
+    parser.add_argument("--interface", default=None, help="bind the requests to this interface, e.g. 'lo' (see _CARD_INTERFACE)")
+    parser.add_argument("--maker-note-size", type=int, default=16 * 1024, help="bytes of the maker note in the Exif data of the dated files")
+    parser.add_argument("--results", default=_RESULTS, help="file the results are appended to")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    ezshare._WORKERS = args.workers
+    ezshare._CARD_INTERFACE = args.interface
+    run = {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": get_commit(),
+        "file_size": args.file_size,
+        "latency": args.latency,
+        "bandwidth": args.bandwidth,
+        "drop_rate": args.drop_rate,
+        "workers": args.workers,
+        "interface": args.interface,
+        "maker_note_size": args.maker_note_size,
+    }
+
+    results = []
+    for count in [int(size) for size in args.sizes.split(",")]:
+        card = cardsim.Card.generate(count, args.file_size, latency=args.latency, bandwidth=args.bandwidth, drop_rate=args.drop_rate)
+        with tempfile.TemporaryDirectory() as temp:
+            results += benchmark_card(card, count, temp)
+            results += benchmark_dates(min(count, _SHOTS), args.maker_note_size, temp)
+
+    with open(args.results, "a") as file:
+        for result in results:
+            file.write(json.dumps(dict(run, **result)) + "\n")
+
+    print(f"{'benchmark':<16}{'files':>8}{'seconds':>10}{'files/s':>12}{'MB/s':>10}")
+    for result in results:
+        mb = f"{result['bytes_per_second'] / 1e6:.2f}" if result.get("bytes_per_second") else "-"
+        print(f"{result['benchmark']:<16}{result['files']:>8}{result['seconds']:>10.3f}{result['files_per_second']:>12.1f}{mb:>10}")
+    print(f"Appended {len(results)} results to '{args.results}'")
+
+
+def benchmark_card(card, count, temp):
+    server = cardsim.serve(card)
+    ezshare._CARD = server.url
+    ezshare._TEMP = f"{temp}/upload"
+    ezshare._PARTIAL = f"{temp}/upload.partial"
+    os.makedirs(ezshare._PARTIAL)
+    ezhistory._DATABASE = f"{temp}/history.sqlite"
+    ezjournal._JOURNALS = temp
+    results = []
+
+    try:
+        with ezjournal.Journal("benchmark", "benchmark") as journal, ezhistory.History("benchmark") as history, ezshare.create_session() as session:
+
+            # listing all pages of the card
+            source = ezshare.CardSource(session)
+            start = time.perf_counter()
+            files = source.list(history, journal)
+            results.append(result("listing", count, time.perf_counter() - start))
+            assert len(files) == count, f"listed {len(files)} of {count} files"
+
+            # downloading, dating and staging all files (the uploader only collects them)
+            uploader = ezupload.Uploader(ezshare._TEMP)
+            start = time.perf_counter()
+            staged = [result for (directory, filename, result) in ezingest.ingest(source, "benchmark", files, history, ezretry.Policy("benchmark"), journal, uploader) if result]
+            seconds = time.perf_counter() - start
+            results.append(result("download", len(staged), seconds, sum(os.path.getsize(filepath) for filepath in staged)))
+
+
+            # looking up every file in a history that knows all of them
+            for (directory, filename, size, taken) in files:
+                history.add(directory, filename)
+            history.commit()
+            start = time.perf_counter()
+            known = sum(1 for (directory, filename, size, taken) in files if history.contains(directory, filename))
+            results.append(result("history", count, time.perf_counter() - start))
+            assert known == count, f"history knows {known} of {count} files"
+
+            # notifying after every file (at most _NOTIFICATIONS): by starting a
+            # process like 'spd-say' in the loop, and through eznotify
+            notifications = min(count, _NOTIFICATIONS)
+            start = time.perf_counter()
+            for i in range(notifications):
+                subprocess.run(["true"])
+            results.append(result("notify_sync", notifications, time.perf_counter() - start))
+            notifier = eznotify.Notifier(lambda message: subprocess.run(["true"]))
+            start = time.perf_counter()
+            for i in range(notifications):
+                notifier.progress(f"{i + 1} files done")
+            results.append(result("notify_async", notifications, time.perf_counter() - start))
+            notifier.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return results
+
+
+def benchmark_dates(count, maker_note_size, temp):
+    # dates 'count' shots of a JPEG and a raw file (with the raw image left
+    # out as a hole in the file) with ezexif, and with a full exifread parse
+    # like the daemons did before ezexif
+    directory = f"{temp}/dates"
+    os.makedirs(directory)
+    start = datetime.datetime(2024, 5, 1, 10, 0, 0)
+    files = {"jpeg": [], "raw": []}
+    for i in range(count):
+        taken = start + datetime.timedelta(minutes=i)
+        filepath = f"{directory}/DSCF{i:04d}.JPG"
+        with open(filepath, "wb") as file:
+            file.write(cardsim.make_camera_jpeg(256 * 1024, taken, maker_note_size))
+        files["jpeg"].append((filepath, taken.strftime('%Y%m%d')))
+        filepath = f"{directory}/DSCF{i:04d}.DNG"
+        with open(filepath, "wb") as file:
+            file.write(cardsim.make_camera_raw(taken, maker_note_size))
+            file.truncate(25 * 1024 * 1024)
+        files["raw"].append((filepath, taken.strftime('%Y%m%d')))
+
+    results = []
+    for (kind, shots) in files.items():
+        start = time.perf_counter()
+        for (filepath, date) in shots:
+            assert ezexif.get_date(ezexif.read_head(filepath), filepath) == date, f"ezexif misdated '{filepath}'"
+        results.append(result(f"exif_{kind}", count, time.perf_counter() - start))
+        start = time.perf_counter()
+        for (filepath, date) in shots:
+            with open(filepath, 'rb') as f:
+                assert exifread.process_file(f)['EXIF DateTimeOriginal'].values.startswith(f"{date[:4]}:{date[4:6]}:{date[6:]}"), f"exifread misdated '{filepath}'"
+        results.append(result(f"exifread_{kind}", count, time.perf_counter() - start))
+    return results
+
+
+def result(benchmark, files, seconds, size=None):
+    return {
+        "benchmark": benchmark,
+        "files": files,
+        "seconds": seconds,
+        "files_per_second": files / seconds if seconds else 0.0,
+        "bytes_per_second": size / seconds if size and seconds else None,
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return None
+
+
+if __name__ == "__main__":
+    main()
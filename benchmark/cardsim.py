@@ -0,0 +1,343 @@
+#!/usr/bin/python3
+import datetime
+import html
+import http.server
+import random
+import struct
+import threading
+import time
+import urllib.parse
+
+
+#local stand-in for an ez Share card at http://192.168.4.1/, serving the
+#paginated 'mphoto' listing, thumbnails and the files in 'DCIM/<dir>/<file>';
+#latency, bandwidth and dropped connections can be configured to mimic a
+#card in a camera at some distance
+
+#number of pictures on a page of the 'mphoto' listing
+_PAGE_SIZE = 40
+
+#files are sent in blocks of this size, to be able to cap the bandwidth
+_BLOCK_SIZE = 16 * 1024
+
+
+class Card:
+
+    def __init__(self, files, latency=0.0, bandwidth=None, drop_rate=0.0):
+        # 'files' is a list of tuples (directory, filename, size, datetime);
+        # 'latency' in seconds is added to every request, 'bandwidth' in
+        # bytes per second is shared by all connections, and a fraction
+        # 'drop_rate' of the file transfers is cut off halfway
+        self.files = files
+        self.index = {(directory, filename): (size, taken) for (directory, filename, size, taken) in files}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.drop_rate = drop_rate
+        self.lock = threading.Lock()
+        self.next_send = time.monotonic()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.drops = 0
+
+    @classmethod
+    def generate(cls, count, size=64 * 1024, **kwargs):
+        # a card with 'count' pictures of 'size' bytes in folders of 100
+        start = datetime.datetime(2024, 5, 1, 10, 0, 0)
+        files = []
+        for i in range(count):
+            directory = f"{100 + i // 100}_FUJI"
+            filename = f"DSCF{i % 10000:04d}.JPG"
+            files.append((directory, filename, size, start + datetime.timedelta(minutes=i)))
+        return cls(files, **kwargs)
+
+    def throttle(self, length):
+        # waits until 'length' more bytes fit in the bandwidth
+        if not self.bandwidth:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.next_send = max(self.next_send, now) + length / self.bandwidth
+            delay = self.next_send - length / self.bandwidth - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def make_jpeg_header(taken):
+    # the start of a JPEG with an APP1 segment holding DateTimeOriginal
+    value = taken.strftime('%Y:%m:%d %H:%M:%S').encode("ascii") + b"\x00"
+    # TIFF header, IFD0 with the Exif IFD pointer, Exif IFD with DateTimeOriginal
+    tiff = b"II*\x00" + struct.pack("<I", 8)
+    tiff += struct.pack("<H", 1) + struct.pack("<HHII", 0x8769, 4, 1, 26) + struct.pack("<I", 0)
+    tiff += struct.pack("<H", 1) + struct.pack("<HHII", 0x9003, 2, len(value), 44) + struct.pack("<I", 0)
+    tiff += value
+    app1 = b"Exif\x00\x00" + tiff
+    return b"\xff\xd8" + b"\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1
+
+
+def make_file(size, taken):
+    header = make_jpeg_header(taken)
+    return header + bytes(max(size - len(header) - 2, 0)) + b"\xff\xd9"
+
+
+#TIFF field types: ASCII, SHORT, LONG, RATIONAL, UNDEFINED
+_ASCII = 2
+_SHORT = 3
+_LONG = 4
+_RATIONAL = 5
+_UNDEFINED = 7
+
+
+def make_ifd(entries, start, next_ifd=0):
+    # a little endian IFD at offset 'start' of its TIFF (or maker note),
+    # followed by the values that don't fit in an entry; 'entries' is a list
+    # of tuples (tag, type, count, packed values)
+    ifd = struct.pack("<H", len(entries))
+    extra = b""
+    data_start = start + 2 + 12 * len(entries) + 4
+    for (tag, type, count, data) in sorted(entries):
+        if len(data) <= 4:
+            ifd += struct.pack("<HHI", tag, type, count) + data.ljust(4, b"\x00")
+        else:
+            ifd += struct.pack("<HHII", tag, type, count, data_start + len(extra))
+            extra += data + b"\x00" * (len(data) % 2)
+    return ifd + struct.pack("<I", next_ifd) + extra
+
+
+def ascii_entry(tag, text):
+    value = text.encode("ascii") + b"\x00"
+    return (tag, _ASCII, len(value), value)
+
+
+def make_maker_note(size):
+    # a Fujifilm maker note of about 'size' bytes: "FUJIFILM", the offset of
+    # its IFD (relative to the maker note) and an IFD with the settings and
+    # blocks of binary data, like the ones of real cameras
+    entries = [(0x1000 + i, _SHORT, 1, struct.pack("<H", i)) for i in range(60)]
+    block = 512
+    for i in range(max(size - 12 - 2 - 12 * len(entries) - 4, 0) // (block + 12)):
+        entries.append((0x2000 + i, _UNDEFINED, block, bytes((i + j) % 256 for j in range(block))))
+    return b"FUJIFILM" + struct.pack("<I", 12) + make_ifd(entries, 12)
+
+
+def make_exif(taken, maker_note_size, raw=False):
+    # a little endian TIFF structure like the Exif data of a camera: IFD0
+    # with the camera and image, the Exif IFD with the exposure, the dates and
+    # a maker note of 'maker_note_size' bytes; for a raw file, IFD0 describes
+    # the raw image that follows the header; otherwise IFD1 describes a thumbnail
+    date = taken.strftime('%Y:%m:%d %H:%M:%S')
+    exif_entries = [
+        (0x829a, _RATIONAL, 1, struct.pack("<II", 1, 250)),  # ExposureTime
+        (0x829d, _RATIONAL, 1, struct.pack("<II", 56, 10)),  # FNumber
+        (0x8822, _SHORT, 1, struct.pack("<H", 3)),  # ExposureProgram
+        (0x8827, _SHORT, 1, struct.pack("<H", 400)),  # ISO
+        (0x9000, _UNDEFINED, 4, b"0230"),  # ExifVersion
+        ascii_entry(0x9003, date),  # DateTimeOriginal
+        ascii_entry(0x9004, date),  # DateTimeDigitized
+        (0x9201, _RATIONAL, 1, struct.pack("<II", 797, 100)),  # ShutterSpeedValue
+        (0x9202, _RATIONAL, 1, struct.pack("<II", 497, 100)),  # ApertureValue
+        (0x9204, _RATIONAL, 1, struct.pack("<II", 0, 100)),  # ExposureBiasValue
+        (0x9207, _SHORT, 1, struct.pack("<H", 5)),  # MeteringMode
+        (0x9209, _SHORT, 1, struct.pack("<H", 16)),  # Flash
+        (0x920a, _RATIONAL, 1, struct.pack("<II", 230, 10)),  # FocalLength
+        (0xa001, _SHORT, 1, struct.pack("<H", 1)),  # ColorSpace
+        (0xa002, _LONG, 1, struct.pack("<I", 4896)),  # PixelXDimension
+        (0xa003, _LONG, 1, struct.pack("<I", 3264)),  # PixelYDimension
+        (0xa402, _SHORT, 1, struct.pack("<H", 0)),  # ExposureMode
+        (0xa403, _SHORT, 1, struct.pack("<H", 0)),  # WhiteBalance
+        (0xa406, _SHORT, 1, struct.pack("<H", 0)),  # SceneCaptureType
+        ascii_entry(0xa434, "XF23mmF2"),  # LensModel
+    ]
+    if maker_note_size:
+        maker_note = make_maker_note(maker_note_size)
+        exif_entries.append((0x927c, _UNDEFINED, len(maker_note), maker_note))  # MakerNote
+    image_entries = [
+        ascii_entry(0x010f, "FUJIFILM"),  # Make
+        ascii_entry(0x0110, "X100S"),  # Model
+        (0x0112, _SHORT, 1, struct.pack("<H", 1)),  # Orientation
+        (0x011a, _RATIONAL, 1, struct.pack("<II", 72, 1)),  # XResolution
+        (0x011b, _RATIONAL, 1, struct.pack("<II", 72, 1)),  # YResolution
+        (0x0128, _SHORT, 1, struct.pack("<H", 2)),  # ResolutionUnit
+        ascii_entry(0x0131, "Digital Camera X100S Ver1.10"),  # Software
+        ascii_entry(0x0132, date),  # DateTime
+    ]
+    if raw:
+        image_entries += [
+            (0x0100, _LONG, 1, struct.pack("<I", 4896)),  # ImageWidth
+            (0x0101, _LONG, 1, struct.pack("<I", 3264)),  # ImageLength
+            (0x0102, _SHORT, 1, struct.pack("<H", 16)),  # BitsPerSample
+            (0x0103, _SHORT, 1, struct.pack("<H", 1)),  # Compression
+        ]
+    # the offsets of the Exif IFD, the thumbnail and the raw image depend on
+    # the size of IFD0, which doesn't depend on their values
+    pointers = [(0x8769, _LONG, 1, struct.pack("<I", 0))]  # ExifOffset
+    if raw:
+        pointers += [(0x0111, _LONG, 1, struct.pack("<I", 0)), (0x0117, _LONG, 1, struct.pack("<I", 0))]  # StripOffsets, StripByteCounts
+    ifd0_size = len(make_ifd(image_entries + pointers, 8))
+    exif_start = 8 + ifd0_size
+    exif = make_ifd(exif_entries, exif_start)
+    end = exif_start + len(exif)
+    if raw:
+        pointers = [(0x8769, _LONG, 1, struct.pack("<I", exif_start)),
+                    (0x0111, _LONG, 1, struct.pack("<I", end)),
+                    (0x0117, _LONG, 1, struct.pack("<I", 4896 * 3264 * 2))]
+        return b"II*\x00" + struct.pack("<I", 8) + make_ifd(image_entries + pointers, 8) + exif
+    thumbnail = b"\xff\xd8" + bytes(8 * 1024) + b"\xff\xd9"
+    thumbnail_entries = [
+        (0x0103, _SHORT, 1, struct.pack("<H", 6)),  # Compression
+        (0x0201, _LONG, 1, struct.pack("<I", 0)),  # JPEGInterchangeFormat
+        (0x0202, _LONG, 1, struct.pack("<I", len(thumbnail))),  # JPEGInterchangeFormatLength
+    ]
+    ifd1_size = len(make_ifd(thumbnail_entries, end))
+    thumbnail_entries[1] = (0x0201, _LONG, 1, struct.pack("<I", end + ifd1_size))
+    pointers = [(0x8769, _LONG, 1, struct.pack("<I", exif_start))]
+    return (b"II*\x00" + struct.pack("<I", 8) + make_ifd(image_entries + pointers, 8, next_ifd=end) + exif
+            + make_ifd(thumbnail_entries, end) + thumbnail)
+
+
+def make_camera_jpeg(size, taken, maker_note_size):
+    # a JPEG with Exif data like a camera's (see make_exif())
+    app1 = b"Exif\x00\x00" + make_exif(taken, maker_note_size)
+    header = b"\xff\xd8" + b"\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1
+    return header + bytes(max(size - len(header) - 2, 0)) + b"\xff\xd9"
+
+
+def make_camera_raw(taken, maker_note_size):
+    # the header of a TIFF based raw file (like DNG, NEF or ARW) with Exif
+    # data like a camera's; the raw image is expected to follow it
+    return make_exif(taken, maker_note_size, raw=True)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"  # keep-alive, like the card
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+    def do_GET(self):
+        self.handle_request(head=False)
+
+    def handle_request(self, head):
+        card = self.server.card
+        with card.lock:
+            card.requests += 1
+        if card.latency:
+            time.sleep(card.latency)
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == "/mphoto":
+            self.send_listing(int(query.get("page", ["1"])[0]), head)
+        elif url.path == "/thumbnail":
+            key = (query.get("fdir", [""])[0], query.get("fname", [""])[0])
+            if key in card.index:
+                self.send_file(make_file(4 * 1024, card.index[key][1]), head, drop=False)
+            else:
+                self.send_error(404)
+        elif url.path.startswith("/DCIM/"):
+            parts = urllib.parse.unquote(url.path).split("/")
+            key = tuple(parts[2:4])
+            if len(parts) == 4 and key in card.index:
+                (size, taken) = card.index[key]
+                self.send_file(make_file(size, taken), head, drop=True)
+            else:
+                self.send_error(404)
+        else:
+            self.send_error(404)
+
+    def send_listing(self, page, head):
+        card = self.server.card
+        files = card.files[(page - 1) * _PAGE_SIZE:page * _PAGE_SIZE]
+        imgs = "\n".join(
+            f'<img src="thumbnail?fname={html.escape(filename)}&amp;fdir={html.escape(directory)}&amp;ftype=0&amp;time={int(taken.timestamp())}">'
+            for (directory, filename, size, taken) in files)
+        more = page * _PAGE_SIZE < len(card.files)
+        post = f'<div id="post"><a href="mphoto?page={page + 1}">Next</a></div>' if more else '<div id="post"></div>'
+        # the card's own pages have more links after div#post, which aren't pages of the listing
+        footer = '<div id="footer"><a href="dir?dir=A:">Folders</a></div>'
+        body = f"<html><body>\n{imgs}\n{post}\n{footer}\n</body></html>".encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def send_file(self, content, head, drop):
+        card = self.server.card
+        (start, end) = (0, len(content))
+        range_header = self.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            (first, last) = range_header[len("bytes="):].split("-", 1)
+            if first:
+                (start, end) = (int(first), int(last) + 1 if last else len(content))
+            else:
+                (start, end) = (max(len(content) - int(last), 0), len(content))
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(content)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            end = min(end, len(content))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(content)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        if head:
+            return
+        # a dropped transfer stops halfway and closes the connection
+        cut = end
+        if drop and card.drop_rate and random.random() < card.drop_rate:
+            cut = start + (end - start) // 2
+            with card.lock:
+                card.drops += 1
+        for position in range(start, cut, _BLOCK_SIZE):
+            block = content[position:min(position + _BLOCK_SIZE, cut)]
+            card.throttle(len(block))
+            self.wfile.write(block)
+            with card.lock:
+                card.bytes_sent += len(block)
+        if cut < end:
+            self.close_connection = True
+            self.wfile.flush()
+            self.connection.shutdown(2)
+
+
+class CardServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, card, port=0):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.card = card
+        self.url = f"http://127.0.0.1:{self.server_address[1]}/"
+
+
+def serve(card, port=0):
+    # starts serving 'card' on a background thread; use server.url as the
+    # address of the card and server.shutdown() to stop
+    server = CardServer(card, port)
+    threading.Thread(target=server.serve_forever, name="cardsim", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve a simulated ez Share card")
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--size", type=int, default=64 * 1024, help="bytes per file")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="fraction of transfers cut off")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    card = Card.generate(args.files, args.size, latency=args.latency, bandwidth=args.bandwidth, drop_rate=args.drop_rate)
+    server = CardServer(card, args.port)
+    print(f"Serving {args.files} files at {server.url}")
+    server.serve_forever()
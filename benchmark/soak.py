@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+import argparse
+import datetime
+import json
+import logging
+import os
+import os.path
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cardsim
+
+
+#runs the main loops of ezshare.py and usbdcim.py for many sessions in a row,
+#against stand-ins for everything outside the Pi: a fake nmcli module (cards
+#whose wifi shows up for one visit), simulated cards (see cardsim.py), a
+#directory as USB mount and a fake gphotos-uploader-cli with a configurable
+#latency and failure rate; it reports the latency from a card showing up to
+#its files being uploaded, and how memory, threads, open files, the staging
+#folder and the history grow over the sessions, so leaks and slowdowns that
+#would take weeks to show up on the Pi show up here
+_RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "soak.jsonl")
+
+#seconds to wait for a session to end before giving up
+_TIMEOUT = 120
+
+#the ExcludePatterns of the gphotos-uploader-cli configuration in the README,
+#which the fake uploader applies like the real one, to the paths relative to
+#its SourceFolder
+_EXCLUDE_PATTERNS = []
+
+_FAKE_UPLOADER = '''#!/usr/bin/env python3
+import fnmatch, json, os, random, sys, time
+source = os.environ["SOAK_SOURCE"]
+exclude = json.loads(os.environ["SOAK_EXCLUDE_PATTERNS"])
+time.sleep(float(os.environ["SOAK_UPLOAD_LATENCY"]))
+files = []
+for (directory, dirs, names) in os.walk(source):
+    for name in names:
+        path = os.path.relpath(f"{directory}/{name}", source)
+        if not any(fnmatch.fnmatch(path, pattern) for pattern in exclude):
+            files.append(f"{directory}/{name}")
+errors = 0
+for file in files:
+    if random.random() < float(os.environ["SOAK_UPLOAD_FAILURE_RATE"]):
+        print(f"Failed to upload {file}: simulated", flush=True)
+        errors += 1
+    else:
+        print(f"Uploaded {file}", flush=True)
+print(f"{len(files)} processed, {len(files) - errors} uploaded, {errors} with errors")
+'''
+
+
+class FakeNmcli(types.ModuleType):
+    # stands in for the nmcli module: a card's wifi is in range from show()
+    # until it has been connected to once, like a camera that is switched on
+    # for one visit
+
+    def __init__(self):
+        super().__init__("nmcli")
+        self.lock = threading.Lock()
+        self.visible = {}  # ssid -> url of its card
+        self.cards = {}  # ssid -> url, including the ones that were visited
+        self.connection = FakeConnection()
+        self.device = types.SimpleNamespace(
+            wifi=self.wifi,
+            wifi_connect=self.wifi_connect,
+            wifi_rescan=lambda ifname=None, ssid=None: None,
+            disconnect=lambda ifname, wait=None: None,
+            reapply=lambda ifname: None,
+        )
+
+    def show(self, ssid, url):
+        with self.lock:
+            self.visible[ssid] = url
+            self.cards[ssid] = url
+
+    def wifi(self, ifname=None, rescan=None):
+        with self.lock:
+            return [types.SimpleNamespace(ssid=ssid, signal=70) for ssid in self.visible]
+
+    def wifi_connect(self, ssid, password=None, ifname=None, wait=None):
+        import ezshare
+        with self.lock:
+            if ssid not in self.cards:
+                raise Exception(f"No network with SSID '{ssid}' found")
+            self.visible.pop(ssid, None)
+            ezshare._CARD = self.cards[ssid]
+
+
+class FakeConnection:
+    # nmcli.connection() lists the connections, nmcli.connection.up() etc. change them
+
+    def __call__(self):
+        return [types.SimpleNamespace(name="home", device="wlan0")]
+
+    def up(self, name, wait=None):
+        pass
+
+    def show(self, name, show_secrets=False, active=False):
+        return {}
+
+    def modify(self, name, options):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run ezshare.py and usbdcim.py for many sessions against stand-ins")
+    parser.add_argument("--daemon", choices=["ezshare", "usbdcim"], default="ezshare")
+    parser.add_argument("--sessions", type=int, default=100, help="number of times a card shows up")
+    parser.add_argument("--files", type=int, default=5, help="new files on the card per session")
+    parser.add_argument("--file-size", type=int, default=64 * 1024, help="bytes per file")
+    parser.add_argument("--upload-latency", type=float, default=0.0, help="seconds per push of the fake uploader")
+    parser.add_argument("--upload-failure-rate", type=float, default=0.0, help="fraction of the files that fail to upload")
+    parser.add_argument("--results", default=_RESULTS, help="file the results are appended to")
+    args = parser.parse_args()
+
+    nmcli = FakeNmcli()
+    sys.modules["nmcli"] = nmcli
+    # there are no speakers either
+    sys.modules.setdefault("beepy", types.SimpleNamespace(beep=lambda sound=None: None))
+    import ezhistory
+    import ezjournal
+    import ezmetrics
+    import ezupload
+
+    with tempfile.TemporaryDirectory() as temp:
+        ezhistory._DATABASE = f"{temp}/history.sqlite"
+        ezjournal._JOURNALS = temp
+        ezmetrics._SESSIONS = f"{temp}/sessions.jsonl"
+        ezmetrics._TEXTFILE_DIR = f"{temp}/textfile"
+        ezupload._UPLOADER = f"{temp}/gphotos-uploader-cli"
+        ezupload._RETRY_SLEEP = 0.1
+        with open(ezupload._UPLOADER, "w") as file:
+            file.write(_FAKE_UPLOADER)
+        os.chmod(ezupload._UPLOADER, 0o755)
+        os.environ["SOAK_UPLOAD_LATENCY"] = str(args.upload_latency)
+        os.environ["SOAK_UPLOAD_FAILURE_RATE"] = str(args.upload_failure_rate)
+        os.environ["SOAK_EXCLUDE_PATTERNS"] = json.dumps(_EXCLUDE_PATTERNS)
+
+        if args.daemon == "ezshare":
+            samples = soak_ezshare(args, nmcli, temp)
+        else:
+            samples = soak_usbdcim(args, temp)
+
+    run = {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "daemon": args.daemon,
+        "sessions": args.sessions,
+        "files": args.files,
+        "file_size": args.file_size,
+        "upload_latency": args.upload_latency,
+        "upload_failure_rate": args.upload_failure_rate,
+    }
+    report = summarize(samples)
+    with open(args.results, "a") as file:
+        file.write(json.dumps(dict(run, **report)) + "\n")
+    print_report(report)
+    print(f"Appended the results to '{args.results}'")
+
+
+def soak_ezshare(args, nmcli, temp):
+    import ezshare
+    logging.getLogger().setLevel(logging.WARNING)
+    ezshare._TEMP = f"{temp}/upload"
+    ezshare._PARTIAL = f"{temp}/upload.partial"
+    ezshare._MIN_SCAN = 0.05
+    ezshare._MAX_SCAN = 0.05
+    ezshare._COOLDOWN = 0
+    ezshare._STATUS_PORT = None
+    ezshare._notifier.play = lambda message: None
+    os.environ["SOAK_SOURCE"] = ezshare._TEMP
+    card = cardsim.Card([])
+    server = cardsim.serve(card)
+    threading.Thread(target=ezshare.main, name="ezshare", daemon=True).start()
+    try:
+        samples = []
+        for session in range(args.sessions):
+            add_files(card, args.files, args.file_size)
+            start = time.perf_counter()
+            nmcli.show("ez Share SOAK", server.url)
+            wait_for_session(session + 1)
+            samples.append(sample(session, time.perf_counter() - start, ezshare._TEMP))
+        return samples
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def soak_usbdcim(args, temp):
+    import usbdcim
+    logging.getLogger().setLevel(logging.WARNING)
+    usbdcim._TEMP = f"{temp}/upload"
+    usbdcim._PARTIAL = f"{temp}/upload.partial"
+    usbdcim._USB = f"{temp}/USB"
+    usbdcim._MIN_SCAN = 0.05
+    usbdcim._MAX_SCAN = 0.05
+    usbdcim._STATUS_PORT = None
+    usbdcim._notifier.play = lambda message: None
+    marker = f"{usbdcim._USB}/ez Share SOAK"
+    # unmounting the card takes its root file away
+    usbdcim.unmount = lambda usb_path: os.remove(marker)
+    os.environ["SOAK_SOURCE"] = usbdcim._TEMP
+    card = cardsim.Card([])
+    threading.Thread(target=usbdcim.main, name="usbdcim", daemon=True).start()
+    samples = []
+    for session in range(args.sessions):
+        for (directory, filename, size, taken) in add_files(card, args.files, args.file_size):
+            os.makedirs(f"{usbdcim._USB}/DCIM/{directory}", exist_ok=True)
+            with open(f"{usbdcim._USB}/DCIM/{directory}/{filename}", "wb") as file:
+                file.write(cardsim.make_file(size, taken))
+        start = time.perf_counter()
+        open(marker, "w").close()
+        wait_for_session(session + 1)
+        samples.append(sample(session, time.perf_counter() - start, usbdcim._TEMP))
+    return samples
+
+
+def add_files(card, count, size):
+    # adds 'count' pictures to 'card', after the ones that are on it; returns them
+    start = datetime.datetime(2024, 5, 1, 10, 0, 0)
+    files = []
+    for i in range(len(card.files), len(card.files) + count):
+        directory = f"{100 + i // 100 % 900}_FUJI"
+        filename = f"DSCF{i % 10000:04d}.JPG"
+        files.append((directory, filename, size, start + datetime.timedelta(minutes=i)))
+    with card.lock:
+        card.files += files
+        card.index.update({(directory, filename): (size, taken) for (directory, filename, size, taken) in files})
+    return files
+
+
+def wait_for_session(count):
+    # waits until 'count' sessions have ended (and their files are uploaded)
+    import ezmetrics
+    deadline = time.perf_counter() + _TIMEOUT
+    while time.perf_counter() < deadline:
+        try:
+            with open(ezmetrics._SESSIONS) as file:
+                if sum(1 for line in file) >= count:
+                    return
+        except FileNotFoundError:
+            pass
+        time.sleep(0.01)
+    raise Exception(f"Session {count} didn't end within {_TIMEOUT} seconds")
+
+
+def sample(session, latency, temp):
+    import ezhistory
+    return {
+        "session": session,
+        "latency": latency,
+        "rss": get_rss(),
+        "threads": threading.active_count(),
+        "open_files": len(os.listdir("/proc/self/fd")),
+        "temp_bytes": get_size(temp),
+        "history_bytes": sum(os.path.getsize(filepath) for filepath in (ezhistory._DATABASE, f"{ezhistory._DATABASE}-wal") if os.path.exists(filepath)),
+    }
+
+
+def get_rss():
+    # current resident memory in bytes
+    with open("/proc/self/status") as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def get_size(directory):
+    return sum(os.path.getsize(f"{path}/{name}") for (path, dirs, names) in os.walk(directory) for name in names)
+
+
+def summarize(samples):
+    # compares the first and the last tenth of the sessions
+    tenth = max(len(samples) // 10, 1)
+    (first, last) = (samples[:tenth], samples[-tenth:])
+    report = {
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "peak_temp_bytes": max(s["temp_bytes"] for s in samples),
+    }
+    for part in ("first", "last"):
+        latencies = sorted(s["latency"] for s in (first if part == "first" else last))
+        report[f"{part}_latency_median"] = statistics.median(latencies)
+        report[f"{part}_latency_max"] = latencies[-1]
+    for key in ("rss", "threads", "open_files", "temp_bytes", "history_bytes"):
+        report[f"first_{key}"] = first[0][key]
+        report[f"last_{key}"] = last[-1][key]
+    return report
+
+
+def print_report(report):
+    print(f"{'':<16}{'first':>14}{'last':>14}")
+    print(f"{'latency median':<16}{report['first_latency_median']:>13.3f}s{report['last_latency_median']:>13.3f}s")
+    print(f"{'latency max':<16}{report['first_latency_max']:>13.3f}s{report['last_latency_max']:>13.3f}s")
+    for key in ("rss", "threads", "open_files", "temp_bytes", "history_bytes"):
+        print(f"{key:<16}{report[f'first_{key}']:>14}{report[f'last_{key}']:>14}")
+    print(f"{'peak rss':<16}{report['peak_rss']:>28}")
+    print(f"{'peak temp_bytes':<16}{report['peak_temp_bytes']:>28}")
+
+
+if __name__ == "__main__":
+    main()
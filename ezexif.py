@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+import datetime
+import exifread
+import logging
+import struct
+
+
+#the date a picture was taken is looked up in this many bytes at the start of
+#the file; that covers the APP1 segment of a JPEG, the first IFDs of a TIFF
+#based raw file and the embedded JPEG header of a Fujifilm RAF
+HEAD_SIZE = 128 * 1024
+
+#TIFF tags
+_EXIF_IFD_POINTER = 0x8769
+_DATE_TIME_ORIGINAL = 0x9003
+
+
+def read_head(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read(HEAD_SIZE)
+
+
+def get_date(head, filepath):
+    # returns the date the picture was taken as 'YYYYMMDD'; 'head' holds the
+    # first bytes of the file, the file itself is only read by exifread if the
+    # date isn't found in there; if there's no date at all, today is used
+    try:
+        try:
+            datetime_string = parse_date_time_original(head)
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            logging.debug(f"Error parsing the header of '{filepath}': {e}")
+            datetime_string = None
+        if datetime_string is None:
+            logging.debug(f"No date in the header of '{filepath}', falling back to exifread")
+            with open(filepath, 'rb') as f:
+                tags = exifread.process_file(f, details=False, stop_tag='DateTimeOriginal')
+            datetime_string = tags['EXIF DateTimeOriginal'].values
+        datetime_object = datetime.datetime.strptime(datetime_string, '%Y:%m:%d %H:%M:%S')
+        date = datetime_object.strftime('%Y%m%d')
+        logging.info(f"Fetched the date from exif: '{date}'")
+    except Exception as e:
+        date = datetime.datetime.now().strftime('%Y%m%d')
+        logging.info(f"No date in exif, using today: '{date}'; because: {e}")
+    return date
+
+
+def parse_date_time_original(data):
+    # returns the DateTimeOriginal tag as 'YYYY:MM:DD HH:MM:SS' from the first
+    # bytes of a JPEG, a TIFF based raw file (NEF, ARW, CR2, DNG, ...) or a RAF;
+    # or None if it isn't there
+    if data[:2] == b"\xff\xd8":
+        return parse_jpeg(data, 0)
+    if data[:16] == b"FUJIFILMCCD-RAW ":
+        # the offset of the embedded JPEG is at byte 84
+        (offset,) = struct.unpack_from(">I", data, 84)
+        return parse_jpeg(data, offset)
+    if data[:2] in (b"II", b"MM"):
+        return parse_tiff(data, 0)
+    return None
+
+
+def parse_jpeg(data, position):
+    # walks the JPEG segments up to the APP1 segment with the Exif data
+    if data[position:position + 2] != b"\xff\xd8":
+        return None
+    position += 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            position += 1  # fill byte
+            continue
+        if marker in (0xD9, 0xDA):
+            return None  # end of image or start of the image data: no more headers
+        (length,) = struct.unpack_from(">H", data, position + 2)
+        if marker == 0xE1 and data[position + 4:position + 10] == b"Exif\x00\x00":
+            return parse_tiff(data, position + 10)
+        position += 2 + length
+    return None
+
+
+def parse_tiff(data, start):
+    # follows IFD0 to the Exif IFD and reads DateTimeOriginal from there;
+    # all offsets in a TIFF structure are relative to its start
+    order = {b"II": "<", b"MM": ">"}.get(data[start:start + 2])
+    if not order:
+        return None
+    (ifd0,) = struct.unpack_from(order + "I", data, start + 4)
+    entry = find_ifd_entry(data, start, order, ifd0, _EXIF_IFD_POINTER)
+    if entry is None:
+        return None
+    (exif_ifd,) = struct.unpack_from(order + "I", data, entry + 8)
+    entry = find_ifd_entry(data, start, order, exif_ifd, _DATE_TIME_ORIGINAL)
+    if entry is None:
+        return None
+    (count,) = struct.unpack_from(order + "I", data, entry + 4)
+    if count <= 4:
+        value = data[entry + 8:entry + 8 + count]
+    else:
+        (offset,) = struct.unpack_from(order + "I", data, entry + 8)
+        value = data[start + offset:start + offset + count]
+        if len(value) < count:
+            raise IndexError("DateTimeOriginal is beyond the header")
+    return value.rstrip(b"\x00 ").decode("ascii")
+
+
+def find_ifd_entry(data, start, order, ifd, tag):
+    # returns the position in 'data' of the 12 byte entry of 'tag' in the IFD
+    # at offset 'ifd', or None
+    position = start + ifd
+    (count,) = struct.unpack_from(order + "H", data, position)
+    for i in range(count):
+        entry = position + 2 + 12 * i
+        (entry_tag,) = struct.unpack_from(order + "H", data, entry)
+        if entry_tag == tag:
+            return entry
+    return None
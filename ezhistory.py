@@ -0,0 +1,390 @@
+#!/usr/bin/python3
+import hashlib
+import logging
+import os
+import os.path
+import sqlite3
+import sys
+import threading
+import time
+
+
+#history of all files ever downloaded from each camera, shared by ezshare.py
+#and usbdcim.py; files are identified by (directory, filename, size), so
+#DSCF0001.JPG in 103_FUJI and in 104_FUJI don't collide after the counter wraps
+_HISTORY = os.path.expanduser("~/.ezshare-raspberry-history")
+os.makedirs(_HISTORY, exist_ok=True)
+
+_DATABASE = f"{_HISTORY}/history.sqlite"
+
+#additions are kept in memory and written in batches of this many rows, each
+#in a short transaction of its own, so the database isn't locked for the other
+#daemon while files are being fetched
+_BATCH = 50
+
+#seconds compact() waits for the other daemon to release the database
+_COMPACT_TIMEOUT = 5.0
+
+#files uploaded while a History is open are marked in its next commit: the
+#uploader writing from a connection of its own would wait for the batch the
+#History holds (see set_uploaded())
+_uploaded_lock = threading.Lock()
+_uploaded = []  # paths of uploaded files
+_open = set()  # the Histories that are open
+
+#size stored for files of which the size isn't known (e.g. the flat text files
+#of older versions only list filenames)
+_UNKNOWN = -1
+
+#files with the same content are recognized by their size and a hash of their
+#first and last HASH_BLOCK bytes (the 'partial hash'), whatever their name,
+#folder or card; with _FULL_HASH, a match of a file that can be read locally
+#is confirmed with a hash of its full content
+HASH_BLOCK = 64 * 1024
+_FULL_HASH = False
+
+#number of new files expected on a card that was never visited before
+_NEVER_VISITED = 1000
+
+#states of a file on its way from the card to Google Photos
+DISCOVERED = "discovered"  # listed on the card, not on the Pi yet
+PREVIEWED = "previewed"  # its thumbnail is staged, the file itself isn't on the Pi yet
+FETCHED = "fetched"  # completely on the Pi, not yet in its album
+STAGED = "staged"  # in its album in _TEMP, waiting to be uploaded
+UPLOADED = "uploaded"  # pushed to Google Photos and deleted from _TEMP
+
+
+def connect():
+    db = sqlite3.connect(_DATABASE, timeout=30.0, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS downloaded (
+            camera TEXT NOT NULL,
+            directory TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime INTEGER,
+            PRIMARY KEY (camera, directory, filename, size)
+        ) WITHOUT ROWID""")
+    db.execute("CREATE TABLE IF NOT EXISTS imported (camera TEXT PRIMARY KEY)")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS enumeration (
+            camera TEXT PRIMARY KEY,
+            page TEXT NOT NULL,
+            directory TEXT NOT NULL,
+            filename TEXT NOT NULL
+        )""")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS state (
+            camera TEXT NOT NULL,
+            directory TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            state TEXT NOT NULL,
+            path TEXT,
+            PRIMARY KEY (camera, directory, filename)
+        )""")
+    db.execute("CREATE INDEX IF NOT EXISTS state_path ON state (path)")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS content (
+            size INTEGER NOT NULL,
+            partial_hash TEXT NOT NULL,
+            full_hash TEXT,
+            camera TEXT NOT NULL,
+            directory TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            PRIMARY KEY (size, partial_hash)
+        ) WITHOUT ROWID""")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS visits (
+            camera TEXT PRIMARY KEY,
+            time REAL NOT NULL,
+            previous_time REAL,
+            new_files INTEGER NOT NULL
+        )""")
+    db.commit()
+    return db
+
+
+class History:
+    # indexed store of the downloaded files of one camera; the flat text file
+    # '{_HISTORY}/{camera_name}.txt' of older versions is imported the first time
+
+    def __init__(self, camera_name):
+        self.camera_name = camera_name
+        self.pending = 0  # rows that aren't written yet
+        self.added = {}  # (directory, filename, size) -> mtime, not written yet
+        self.contents = {}  # (size, partial_hash) -> (full_hash, directory, filename), not written yet
+        self.states = {}  # (directory, filename) -> (state, path), not written yet
+        self.lock = threading.Lock()
+        self.db = connect()
+        self.import_text_file()
+        count = self.db.execute("SELECT COUNT(*) FROM downloaded WHERE camera = ?", (camera_name,)).fetchone()[0]
+        logging.info(f"Number of images ever downloaded from '{camera_name}': {count}")
+        with _uploaded_lock:
+            _open.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def import_text_file(self):
+        # filenames from the old text file have no directory and size, so they
+        # match the same filename in any directory
+        if self.db.execute("SELECT 1 FROM imported WHERE camera = ?", (self.camera_name,)).fetchone():
+            return
+        filename = f"{_HISTORY}/{self.camera_name}.txt"
+        try:
+            with open(filename) as file:
+                lines = [line for line in file.read().splitlines() if line]
+        except FileNotFoundError:
+            lines = []
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO downloaded VALUES (?, '', ?, ?, NULL)",
+                                [(self.camera_name, line, _UNKNOWN) for line in lines])
+            self.db.execute("INSERT INTO imported VALUES (?)", (self.camera_name,))
+        if lines:
+            logging.info(f"Imported {len(lines)} filenames from '{filename}'")
+
+    def contains(self, directory, filename, size=None):
+        # a file is known if it was downloaded from the same directory (or from
+        # an unknown directory) and its size matches (or one of both is unknown)
+        size = _UNKNOWN if size is None else size
+        with self.lock:
+            if any(f == filename and d in (directory, '') and (size == _UNKNOWN or s in (size, _UNKNOWN))
+                   for (d, f, s) in self.added):
+                return True
+            row = self.db.execute("""
+                SELECT 1 FROM downloaded
+                WHERE camera = ? AND directory IN (?, '') AND filename = ?
+                AND (? = ? OR size IN (?, ?))
+                LIMIT 1""", (self.camera_name, directory, filename, size, _UNKNOWN, size, _UNKNOWN)).fetchone()
+        return row is not None
+
+    def add(self, directory, filename, size=None, mtime=None):
+        size = _UNKNOWN if size is None else size
+        with self.lock:
+            self.added[(directory, filename, size)] = mtime
+            self._add_pending(1)
+        logging.debug(f"Added '{directory}/{filename}' to the history of '{self.camera_name}'")
+
+    def contains_content(self, size, partial_hash, filepath=None):
+        # True if a file with this content was downloaded before, from any
+        # camera; 'filepath' is a local copy to confirm the match with
+        row = self.get_content(size, partial_hash)
+        if row is None:
+            return False
+        (full_hash, camera, directory, filename) = row
+        if _FULL_HASH and full_hash and filepath and full_hash_of_file(filepath) != full_hash:
+            return False
+        logging.info(f"Same content as '{directory}/{filename}' from '{camera}'")
+        return True
+
+    def get_content(self, size, partial_hash):
+        with self.lock:
+            if (size, partial_hash) in self.contents:
+                (full_hash, directory, filename) = self.contents[(size, partial_hash)]
+                return (full_hash, self.camera_name, directory, filename)
+            return self.db.execute("SELECT full_hash, camera, directory, filename FROM content WHERE size = ? AND partial_hash = ?",
+                                   (size, partial_hash)).fetchone()
+
+    def add_content(self, size, partial_hash, directory, filename, filepath=None):
+        # 'filepath' is the downloaded file, for the full hash
+        full_hash = full_hash_of_file(filepath) if _FULL_HASH and filepath else None
+        with self.lock:
+            self.contents[(size, partial_hash)] = (full_hash, directory, filename)
+            self._add_pending(1)
+
+    def set_state(self, directory, filename, state, path=None):
+        self.set_states([(directory, filename)], state, path)
+
+    def set_states(self, files, state, path=None):
+        # moves the list of tuples (directory, filename) to 'state'; the path
+        # in _TEMP is kept from earlier states if not given; a file that is
+        # discovered again keeps the state it got to before
+        with self.lock:
+            for (directory, filename) in files:
+                previous = self.states.get((directory, filename))
+                if state == DISCOVERED:
+                    if previous is None:
+                        self.states[(directory, filename)] = (state, path)
+                else:
+                    self.states[(directory, filename)] = (state, path if path is not None or previous is None else previous[1])
+            self._add_pending(len(files))
+
+    def get_state(self, directory, filename):
+        with self.lock:
+            pending = self.states.get((directory, filename))
+            if pending and pending[0] != DISCOVERED:
+                return pending[0]
+            row = self.db.execute("SELECT state FROM state WHERE camera = ? AND directory = ? AND filename = ?",
+                                  (self.camera_name, directory, filename)).fetchone()
+        # a file that is discovered again keeps the state it got to before
+        return row[0] if row else (pending[0] if pending else None)
+
+    def set_visit(self, new_files):
+        # remembers when the card was last listed and how many new files it had
+        with self.lock, self.db:
+            self.db.execute("""
+                INSERT INTO visits VALUES (?, ?, NULL, ?)
+                ON CONFLICT (camera)
+                DO UPDATE SET previous_time = time, time = excluded.time, new_files = excluded.new_files""",
+                (self.camera_name, time.time(), new_files))
+
+    def get_enumeration_mark(self):
+        # tuple (page, directory, filename) with the page where the listing of
+        # the card can be resumed, and the first file on that page to check that
+        # the card hasn't changed; or None
+        with self.lock:
+            return self.db.execute("SELECT page, directory, filename FROM enumeration WHERE camera = ?",
+                                   (self.camera_name,)).fetchone()
+
+    def set_enumeration_mark(self, page, directory, filename):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO enumeration VALUES (?, ?, ?, ?)",
+                            (self.camera_name, page, directory, filename))
+
+    def _add_pending(self, count):
+        # a batch that can't be written now (the other daemon holds the
+        # database) stays in memory and is written with the next one
+        self.pending += count
+        if self.pending >= _BATCH:
+            try:
+                self._commit()
+            except sqlite3.Error as e:
+                logging.error(f"Error committing to the history of '{self.camera_name}', trying again with the next batch: {e}")
+
+    def commit(self):
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        # writes the rows kept in memory in one short transaction; raises
+        # sqlite3.Error if that fails, and then they're kept
+        with _uploaded_lock:
+            uploaded = _uploaded[:]
+            _uploaded.clear()
+        states = [(self.camera_name, directory, filename, state, path) for ((directory, filename), (state, path)) in self.states.items()]
+        try:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO downloaded VALUES (?, ?, ?, ?, ?)",
+                                    [(self.camera_name, directory, filename, size, mtime) for ((directory, filename, size), mtime) in self.added.items()])
+                self.db.executemany("INSERT OR REPLACE INTO content VALUES (?, ?, ?, ?, ?, ?)",
+                                    [(size, partial_hash, full_hash, self.camera_name, directory, filename)
+                                     for ((size, partial_hash), (full_hash, directory, filename)) in self.contents.items()])
+                self.db.executemany("""
+                    INSERT INTO state VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (camera, directory, filename)
+                    DO NOTHING""", [row for row in states if row[3] == DISCOVERED])
+                self.db.executemany("""
+                    INSERT INTO state VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (camera, directory, filename)
+                    DO UPDATE SET state = excluded.state, path = COALESCE(excluded.path, path)""", [row for row in states if row[3] != DISCOVERED])
+                self.db.executemany("UPDATE state SET state = ? WHERE path = ?", [(UPLOADED, filepath) for filepath in uploaded])
+        except sqlite3.Error:
+            with _uploaded_lock:
+                _uploaded[:0] = uploaded
+            raise
+        self.added.clear()
+        self.contents.clear()
+        self.states.clear()
+        if uploaded:
+            logging.debug(f"Marked {len(uploaded)} files as uploaded")
+        if self.pending:
+            logging.info(f"Committed {self.pending} files to the history of '{self.camera_name}'")
+            self.pending = 0
+
+    def close(self):
+        # files uploaded from now on are marked by set_uploaded() itself; if
+        # the last batch can't be written, this raises, so the journal of the
+        # session is kept to replay it
+        with _uploaded_lock:
+            _open.discard(self)
+        try:
+            self.commit()
+        finally:
+            self.db.close()
+
+
+def partial_hash(size, head, tail):
+    # 'head' holds the first HASH_BLOCK bytes of the file, 'tail' the last
+    # HASH_BLOCK bytes, or nothing if the file isn't larger than one block
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(size).encode())
+    digest.update(head)
+    digest.update(tail)
+    return digest.hexdigest()
+
+
+def partial_hash_of_file(filepath):
+    # returns tuple (size, partial hash)
+    with open(filepath, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        head = file.read(HASH_BLOCK)
+        tail = b""
+        if size > HASH_BLOCK:
+            file.seek(size - HASH_BLOCK)
+            tail = file.read(HASH_BLOCK)
+    return (size, partial_hash(size, head, tail))
+
+
+def full_hash_of_file(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def expected_new_files(camera_name):
+    # estimates the number of new files on the card of 'camera_name' from the
+    # rate at which new files turned up at the last two visits; a camera that
+    # was never visited is expected to have a lot
+    db = connect()
+    row = db.execute("SELECT time, previous_time, new_files FROM visits WHERE camera = ?", (camera_name,)).fetchone()
+    db.close()
+    if not row:
+        return _NEVER_VISITED
+    (last, previous, new_files) = row
+    if previous is None or last <= previous:
+        return max(new_files, 1)
+    return max(new_files / (last - previous) * (time.time() - last), 1)
+
+
+def set_uploaded(filepaths):
+    # marks the files staged at these paths as uploaded, whatever their camera;
+    # while a History is open, that's done in its next commit
+    with _uploaded_lock:
+        if _open:
+            _uploaded.extend(filepaths)
+            return
+    db = connect()
+    with db:
+        db.executemany("UPDATE state SET state = ? WHERE path = ?", [(UPLOADED, filepath) for filepath in filepaths])
+    db.close()
+
+
+def compact():
+    # folds the write-ahead log into the database and rebuilds the database
+    # file, so lookups stay fast after years of batched additions; this fails
+    # while the other daemon is writing to the database, which is no reason
+    # to stop, it's done next time
+    db = sqlite3.connect(_DATABASE, timeout=_COMPACT_TIMEOUT)
+    try:
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        db.execute("VACUUM")
+        db.execute("ANALYZE")
+        logging.info(f"Compacted '{_DATABASE}'")
+    except sqlite3.Error as e:
+        logging.error(f"Error compacting '{_DATABASE}', trying again next time: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d %(funcName)s] %(message)s', datefmt='%Y-%m-%d:%H:%M:%S', level=logging.INFO)
+    if sys.argv[1:] == ["compact"]:
+        compact()
+    else:
+        print(f"Usage: {sys.argv[0]} compact")
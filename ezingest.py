@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+import ezexif
+import ezhistory
+import ezmetrics
+import ezretry
+import logging
+import os
+import os.path
+import queue
+import threading
+import time
+import traceback
+
+
+#both daemons ingest a card in the same stages: its files are listed
+#(enumerate), copied into a partial folder by a pool of workers (fetch), dated
+#from their first bytes (date), moved into their album and recorded in the
+#history (stage), and handed to the uploader (upload, see ezupload.py); the
+#stages run at the same time, with bounded queues in between, so a stage that
+#falls behind holds up the ones before it instead of piling up files on disk;
+#what differs between the daemons is the Source: the card over http
+#(ezshare.py) or the card mounted as a file system (usbdcim.py)
+
+#files that are fetched (or dated) and wait for the next stage
+_QUEUE_SIZE = 8
+
+#end of the files, passed down the stages
+_DONE = "done"
+
+
+class Source:
+    # where the files of a card come from; files are fetched into 'partial'
+    # by 'workers' parallel fetches and staged into the albums in 'temp'
+
+    def __init__(self, temp, partial, workers):
+        self.temp = temp
+        self.partial = partial
+        self.workers = workers
+
+    def list(self, history, journal):
+        # returns a list of tuples (directory, filename, size, time) of the
+        # files on the card; the size and the time may be None if unknown
+        raise NotImplementedError
+
+    def get_path(self, directory, filename):
+        # the file as a local path, if it has one (a mounted card)
+        return None
+
+    def probe(self, directory, filename, filepath, policy):
+        # returns tuple (size, partial hash) of the file, or None if that
+        # can't be told without fetching it; the first bytes may be left in
+        # 'filepath' as the start of the fetch
+        raise NotImplementedError
+
+    def fetch(self, directory, filename, filepath, policy, journal, size):
+        # copies the file to 'filepath', resuming what's there if it can;
+        # 'size' is the size from probe(), or None; returns tuple (size, head)
+        # where head is the first ezexif.HEAD_SIZE bytes, or None if they
+        # weren't kept
+        raise NotImplementedError
+
+
+def get_camera_name(name, default):
+    # 'name' is the ssid of the card, or the name of its root file on USB:
+    # "ez Share X100S" is camera 'X100S'
+    camera_name = name.split("ez Share", 1)[1].lstrip()
+    if camera_name:
+        logging.info(f"Camera name is: '{camera_name}'")
+    else:
+        camera_name = default
+        logging.warning(f"No camera name, using default: '{camera_name}'")
+    return camera_name
+
+
+def ingest(source, camera_name, files, history, policy, journal, uploader):
+    # ingests the list of tuples (directory, filename, size, time) from
+    # 'source', in that order; yields tuples (directory, filename, result) as
+    # the files are staged, where result is the staged path, None for a copy
+    # of a file that was ingested before, or False on an error; the history,
+    # the journal and the uploader are kept up to date here; a fetch waits
+    # while the uploader is over its disk space budget, and no more fetches
+    # start when there's no space or the card is gone; if the caller stops
+    # early, the fetches that are running are finished and staged
+    fetched = queue.Queue(maxsize=_QUEUE_SIZE)
+    dated = queue.Queue(maxsize=_QUEUE_SIZE)
+    staged = queue.Queue(maxsize=_QUEUE_SIZE)
+    stop = threading.Event()
+    todo = iter(files)
+    lock = threading.Lock()
+    workers = min(source.workers, len(files)) or 1
+    ezmetrics.add_expected([size for (directory, filename, size, taken) in files])
+
+    def _fetch():
+        while not stop.is_set():
+            with lock:
+                file = next(todo, None)
+            if file is None:
+                break
+            if not uploader.wait_for_space():
+                logging.warning("No more disk space for files waiting to be uploaded, the rest is for next time")
+                stop.set()
+                break
+            if policy.is_open():
+                stop.set()
+                break
+            fetched.put((file, fetch_file(source, file, history, policy, journal)))
+        fetched.put(_DONE)
+
+    def _date():
+        done = 0
+        while done < workers:
+            item = fetched.get()
+            if item == _DONE:
+                done += 1
+                continue
+            (file, result) = item
+            dated.put((file, result, date_file(result)))
+        dated.put(_DONE)
+
+    def _stage():
+        count = 0
+        while (item := dated.get()) != _DONE:
+            (file, result, date) = item
+            count += 1
+            logging.info(f"Progress {count} of {len(files)}")
+            staged.put((file, stage_file(source, camera_name, file, result, date, history, journal, uploader)))
+            ezmetrics.add_done(file[2])
+        staged.put(_DONE)
+
+    threads = [threading.Thread(target=_fetch, name=f"fetch-{i}", daemon=True) for i in range(workers)]
+    threads.append(threading.Thread(target=_date, name="date", daemon=True))
+    threads.append(threading.Thread(target=_stage, name="stage", daemon=True))
+    for thread in threads:
+        thread.start()
+    finished = False
+    try:
+        while (item := staged.get()) != _DONE:
+            (file, result) = item
+            yield (file[0], file[1], result)
+        finished = True
+    finally:
+        if not finished:
+            # the stages run empty, so none of them is stuck on a full queue
+            stop.set()
+            while staged.get() != _DONE:
+                pass
+        for thread in threads:
+            thread.join()
+
+
+def fetch_file(source, file, history, policy, journal):
+    # returns tuple (filepath, content, head) of the file fetched into the
+    # partial folder, None if the same content was ingested before, or False
+    (directory, filename) = file[:2]
+    # the directory is in the name, because files with the same name in
+    # different directories may be fetched in parallel
+    filepath = f"{source.partial}/{directory}_{filename}"
+    try:
+        try:
+            content = source.probe(directory, filename, filepath, policy)
+        except ezretry.CardGone:
+            raise
+        except Exception as e:
+            logging.warning(f"Error probing '{directory}/{filename}', fetching it anyway: {e}")
+            content = None
+        if content and history.contains_content(*content, source.get_path(directory, filename)):
+            logging.info(f"Skipping '{directory}/{filename}', its content was ingested before")
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            return None
+        logging.info(f"Going to fetch '{directory}/{filename}'")
+        start = time.perf_counter()
+        # a failed attempt keeps the partial file, so the next one can resume it
+        ((size, head), retries) = policy.run(lambda: source.fetch(directory, filename, filepath, policy, journal, content[0] if content else None),
+                                             f"fetch '{directory}/{filename}'")
+        logging.info(f"Fetched '{filepath}' ({size} bytes)")
+        ezmetrics.add_file(size, time.perf_counter() - start, retries=retries)
+        history.set_state(directory, filename, ezhistory.FETCHED)
+        return (filepath, content, head)
+    except ezretry.CardGone as e:
+        logging.warning(f"Not fetching '{filename}': {e}")
+        return False
+    except Exception as e:
+        logging.error(f"Error fetching '{filename}': {e}")
+        logging.error(traceback.format_exc())
+        return False
+
+
+def date_file(result):
+    # the date the fetched file was taken, from the first bytes that were kept
+    # while fetching, or from the file if the fetch was resumed
+    if not result:
+        return None
+    (filepath, content, head) = result
+    try:
+        with ezmetrics.phase("exif"):
+            return ezexif.get_date(head if head is not None else ezexif.read_head(filepath), filepath)
+    except Exception as e:
+        logging.error(f"Error dating '{filepath}': {e}")
+        return None
+
+
+def stage_file(source, camera_name, file, result, date, history, journal, uploader):
+    # moves the fetched file into {temp}/{date} {camera_name}/{filename} and
+    # records it; returns the staged path, or None or False as fetch_file()
+    (directory, filename, size, mtime) = file
+    mtime = int(mtime) if mtime is not None else None
+    try:
+        if result is None:
+            # a copy of a file that was ingested before isn't fetched again
+            history.add(directory, filename, size, mtime)
+            journal.set_done(directory, filename, size, mtime)
+            return None
+        if not result or date is None:
+            return False
+        (filepath, content, head) = result
+        album_directory = f"{source.temp}/{date} {camera_name}"
+        os.makedirs(album_directory, exist_ok=True)
+        final_filepath = f"{album_directory}/{filename}"
+        os.replace(filepath, final_filepath)
+        logging.info(f"Moved '{filepath}' to '{final_filepath}'")
+        # once staged, a file isn't fetched again, even if uploading fails
+        if content:
+            history.add_content(*content, directory, filename, final_filepath)
+        history.add(directory, filename, size, mtime)
+        history.set_state(directory, filename, ezhistory.STAGED, final_filepath)
+        journal.set_done(directory, filename, size, mtime, final_filepath, content)
+        uploader.add(final_filepath)
+        return final_filepath
+    except Exception as e:
+        logging.error(f"Error staging '{filename}': {e}")
+        logging.error(traceback.format_exc())
+        return False
@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+import ezhistory
+import json
+import logging
+import os
+import os.path
+import threading
+
+
+#journal of the session with one card: what was listed, which files are done
+#and how far the partial downloads got, appended as lines of json and synced
+#to disk as it happens; the history only commits in batches, so when the
+#service is restarted (or the Pi loses power) in the middle of a session, the
+#next session with the card reads the journal to carry on where it stopped;
+#the journal is removed when a session ends normally
+_JOURNALS = os.path.expanduser("~/.ezshare-raspberry-history/journals")
+os.makedirs(_JOURNALS, exist_ok=True)
+
+
+class Journal:
+
+    def __init__(self, daemon, camera_name):
+        self.filepath = f"{_JOURNALS}/{daemon} {camera_name}.jsonl"
+        self.lock = threading.Lock()
+        # what was left by an interrupted session
+        self.entries = read(self.filepath)
+        if self.entries:
+            logging.info(f"Resuming an interrupted session from '{self.filepath}' ({len(self.entries)} entries)")
+        self.file = open(self.filepath, "a")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # after an error (e.g. the history couldn't be committed) the journal
+        # is kept, and replayed by the next session with the card
+        if exc_type is None:
+            self.close()
+        else:
+            with self.lock:
+                self.file.close()
+
+    def append(self, **entry):
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.entries.append(entry)
+
+    def set_listing(self, key, files):
+        # 'key' tells whether the card has changed, 'files' is a list of tuples
+        self.append(event="listing", key=key, files=files)
+
+    def get_listing(self):
+        # returns a tuple (key, files) of the last listing, or None
+        for entry in reversed(self.entries):
+            if entry["event"] == "listing":
+                return (entry["key"], [tuple(file) for file in entry["files"]])
+        return None
+
+    def set_done(self, directory, filename, size=None, mtime=None, path=None, content=None):
+        # a file that is in the history now; 'path' is where it's staged (None
+        # for a copy of an earlier file) and 'content' its tuple (size, partial hash)
+        self.append(event="done", directory=directory, filename=filename, size=size, mtime=mtime, path=path, content=content)
+
+    def set_offset(self, path, offset):
+        # the partial download 'path' is synced to disk up to 'offset'
+        self.append(event="offset", path=path, offset=offset)
+
+    def replay(self, history):
+        # adds the files that were done before the interruption to 'history',
+        # as they may not have been committed there; and cuts the partial
+        # downloads back to what was synced to disk
+        done = [entry for entry in self.entries if entry["event"] == "done"]
+        for entry in done:
+            (directory, filename) = (entry["directory"], entry["filename"])
+            history.add(directory, filename, entry["size"], entry["mtime"])
+            if entry["path"]:
+                history.set_state(directory, filename, ezhistory.STAGED, entry["path"])
+            if entry["content"]:
+                history.add_content(*entry["content"], directory, filename, None)
+        history.commit()
+        offsets = {entry["path"]: entry["offset"] for entry in self.entries if entry["event"] == "offset"}
+        for (path, offset) in offsets.items():
+            try:
+                if os.path.getsize(path) > offset:
+                    os.truncate(path, offset)
+                    logging.info(f"Cut '{path}' back to {offset} bytes")
+            except FileNotFoundError:
+                pass
+        if done:
+            logging.info(f"Replayed {len(done)} files that were done before the interruption")
+
+    def close(self):
+        # the session has ended normally, so everything is in the history
+        with self.lock:
+            self.file.close()
+        os.remove(self.filepath)
+
+
+def read(filepath):
+    # returns the entries of a journal; a line that was cut off by a crash is ignored
+    entries = []
+    try:
+        with open(filepath) as file:
+            for line in file:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logging.warning(f"Ignoring a broken line in '{filepath}'")
+    except FileNotFoundError:
+        pass
+    return entries
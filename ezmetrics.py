@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+import collections
+import contextlib
+import json
+import logging
+import os
+import os.path
+import statistics
+import threading
+import time
+
+
+#timings of the sessions of both daemons: a session runs from detecting a
+#card until its files are uploaded; the current session is kept in this
+#module, so any stage can report to it without passing it around
+
+#every session is appended as a line of json to this file
+_SESSIONS = os.path.expanduser("~/.ezshare-raspberry-history/sessions.jsonl")
+os.makedirs(os.path.dirname(_SESSIONS), exist_ok=True)
+
+#directory of the textfile collector of prometheus-node-exporter; the metrics
+#are only written if it exists
+_TEXTFILE_DIR = "/var/lib/prometheus/node-exporter"
+
+#the throughput in the progress of a session is the average over the last
+#this many seconds
+_WINDOW = 30
+
+_lock = threading.Lock()
+_session = None
+_totals = {}  # counters since the daemon started, by daemon and result
+
+
+def start_session(daemon):
+    global _session
+    with _lock:
+        _session = {
+            "daemon": daemon,
+            "cameras": [],
+            "start": time.time(),
+            "phases": {},
+            "files": 0,
+            "bytes": 0,
+            "retries": 0,
+            "file_rates": [],
+            # progress, see get_progress()
+            "running": [],  # the phases in progress, in the order they started
+            "expected_files": 0,
+            "expected_sizes": [],  # sizes of the expected files, None if unknown
+            "done_sizes": [],  # sizes of the files that are done with
+            "recent": collections.deque(),  # lists [second, bytes transferred]
+        }
+
+
+def add_camera(camera_name):
+    with _lock:
+        if _session is not None:
+            _session["cameras"].append(camera_name)
+
+
+@contextlib.contextmanager
+def phase(name):
+    # times the enclosed code as phase 'name' of the current session; the
+    # durations of a phase that occurs more than once are added up
+    start = time.perf_counter()
+    with _lock:
+        if _session is not None:
+            _session["running"].append(name)
+    try:
+        yield
+    finally:
+        add_phase(name, time.perf_counter() - start)
+        with _lock:
+            if _session is not None and name in _session["running"]:
+                _session["running"].remove(name)
+
+
+def add_phase(name, seconds):
+    with _lock:
+        if _session is not None:
+            _session["phases"][name] = _session["phases"].get(name, 0.0) + seconds
+
+
+def add_file(size, seconds, retries=0):
+    with _lock:
+        if _session is not None:
+            _session["files"] += 1
+            _session["bytes"] += size
+            _session["retries"] += retries
+            if seconds > 0:
+                _session["file_rates"].append(size / seconds)
+
+
+def add_expected(sizes):
+    # the files that are about to be transferred, by their sizes (None if unknown)
+    with _lock:
+        if _session is not None:
+            _session["expected_files"] += len(sizes)
+            _session["expected_sizes"] += sizes
+
+
+def add_done(size):
+    # an expected file is done with (transferred, skipped or failed); 'size'
+    # is the size it was expected with
+    with _lock:
+        if _session is not None:
+            _session["done_sizes"].append(size)
+
+
+def add_bytes(count):
+    # bytes transferred just now, for the throughput in the progress
+    second = int(time.time())
+    with _lock:
+        if _session is not None:
+            recent = _session["recent"]
+            if recent and recent[-1][0] == second:
+                recent[-1][1] += count
+            else:
+                recent.append([second, count])
+            while recent[0][0] < second - _WINDOW:
+                recent.popleft()
+
+
+def get_progress():
+    # returns a dict with the progress of the current session: the phases in
+    # progress, the files and bytes done and expected, the throughput over
+    # the last _WINDOW seconds and the estimated seconds left; or None if
+    # there's no session; files of an unknown size count as the average one
+    with _lock:
+        if _session is None:
+            return None
+        now = time.time()
+        recent = [(second, count) for (second, count) in _session["recent"] if second >= now - _WINDOW]
+        known = [size for size in _session["expected_sizes"] if size is not None]
+        average = sum(known) / len(known) if known else 0
+        done = _session["done_sizes"]
+        expected_bytes = sum(size if size is not None else average for size in _session["expected_sizes"])
+        done_bytes = sum(size if size is not None else average for size in done)
+        progress = {
+            "daemon": _session["daemon"],
+            "cameras": list(_session["cameras"]),
+            "phases": list(_session["running"]),
+            "seconds": now - _session["start"],
+            "files_done": len(done),
+            "files_left": _session["expected_files"] - len(done),
+            "bytes_done": round(done_bytes),
+            "bytes_left": max(round(expected_bytes - done_bytes), 0),
+        }
+    # the window starts at the first transfer, if that was less than _WINDOW ago
+    seconds = min(now - recent[0][0], _WINDOW) if recent else 0
+    progress["bytes_per_second"] = sum(count for (second, count) in recent) / seconds if seconds >= 1 else None
+    progress["eta_seconds"] = (progress["bytes_left"] / progress["bytes_per_second"]
+                               if progress["bytes_per_second"] else (0 if not progress["files_left"] else None))
+    return progress
+
+
+def end_session(success):
+    # writes the current session to the json log and the textfile collector
+    global _session
+    with _lock:
+        session = _session
+        _session = None
+    if session is None:
+        return
+    session["end"] = time.time()
+    session["success"] = success
+    duration = session["end"] - session["start"]
+    session["bytes_per_second"] = session["bytes"] / duration if duration > 0 else 0.0
+    rates = session.pop("file_rates")
+    for key in ("running", "expected_files", "expected_sizes", "done_sizes", "recent"):
+        del session[key]
+    session["file_bytes_per_second"] = {
+        "min": min(rates),
+        "median": statistics.median(rates),
+        "max": max(rates),
+    } if rates else None
+    try:
+        with open(_SESSIONS, "a") as file:
+            file.write(json.dumps(session) + "\n")
+    except Exception as e:
+        logging.error(f"Error writing the session to '{_SESSIONS}': {e}")
+    phases = ", ".join(f"{name} {seconds:.1f}s" for (name, seconds) in session["phases"].items())
+    logging.info(f"Session took {duration:.1f}s ({phases}); {session['files']} files, {session['bytes']} bytes, {session['retries']} retries")
+    write_textfile(session)
+
+
+def write_textfile(session):
+    daemon = session["daemon"]
+    result = "success" if session["success"] else "failure"
+    with _lock:
+        totals = _totals.setdefault(daemon, {"success": 0, "failure": 0, "files": 0, "bytes": 0, "retries": 0})
+        totals[result] += 1
+        totals["files"] += session["files"]
+        totals["bytes"] += session["bytes"]
+        totals["retries"] += session["retries"]
+        totals = dict(totals)
+    if not os.path.isdir(_TEXTFILE_DIR):
+        logging.debug(f"No textfile collector at '{_TEXTFILE_DIR}'")
+        return
+    label = f'daemon="{daemon}"'
+    lines = [
+        "# HELP ezshare_sessions_total Sessions since the daemon started.",
+        "# TYPE ezshare_sessions_total counter",
+        f'ezshare_sessions_total{{{label},result="success"}} {totals["success"]}',
+        f'ezshare_sessions_total{{{label},result="failure"}} {totals["failure"]}',
+        "# HELP ezshare_files_total Files transferred since the daemon started.",
+        "# TYPE ezshare_files_total counter",
+        f"ezshare_files_total{{{label}}} {totals['files']}",
+        "# HELP ezshare_bytes_total Bytes transferred since the daemon started.",
+        "# TYPE ezshare_bytes_total counter",
+        f"ezshare_bytes_total{{{label}}} {totals['bytes']}",
+        "# HELP ezshare_retries_total Transfer retries since the daemon started.",
+        "# TYPE ezshare_retries_total counter",
+        f"ezshare_retries_total{{{label}}} {totals['retries']}",
+        "# HELP ezshare_last_session_phase_seconds Duration of each phase of the last session.",
+        "# TYPE ezshare_last_session_phase_seconds gauge",
+    ]
+    lines += [f'ezshare_last_session_phase_seconds{{{label},phase="{name}"}} {seconds:.3f}' for (name, seconds) in session["phases"].items()]
+    lines += [
+        "# HELP ezshare_last_session_seconds Duration of the last session.",
+        "# TYPE ezshare_last_session_seconds gauge",
+        f"ezshare_last_session_seconds{{{label}}} {session['end'] - session['start']:.3f}",
+        "# HELP ezshare_last_session_bytes_per_second Throughput of the last session.",
+        "# TYPE ezshare_last_session_bytes_per_second gauge",
+        f"ezshare_last_session_bytes_per_second{{{label}}} {session['bytes_per_second']:.1f}",
+        "# HELP ezshare_last_session_timestamp_seconds End of the last session.",
+        "# TYPE ezshare_last_session_timestamp_seconds gauge",
+        f"ezshare_last_session_timestamp_seconds{{{label}}} {session['end']:.0f}",
+    ]
+    # written to a temporary file first, so the collector never reads half a file
+    filename = f"{_TEXTFILE_DIR}/{daemon}.prom"
+    try:
+        with open(f"{filename}.tmp", "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(f"{filename}.tmp", filename)
+    except Exception as e:
+        logging.error(f"Error writing metrics to '{filename}': {e}")
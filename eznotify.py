@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+import collections
+import logging
+import threading
+import time
+
+
+#beeps and speech are played on a background thread, so they never hold up a
+#transfer; progress (a ping or a count after every file) is played at most
+#once every _INTERVAL seconds, the ones that come in meanwhile are merged into
+#the latest one ("42 files done" instead of 42 announcements); other
+#notifications (start, error, done) are never dropped and are all played, in
+#order, right after the progress that came in before them
+_INTERVAL = 2.0
+
+_EVENT = "event"
+_STOP = "stop"
+
+
+class Notifier:
+    # 'play' is called with each message on the background thread, e.g. to beep
+    # or to say it
+
+    def __init__(self, play, interval=_INTERVAL):
+        self.play = play
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.events = collections.deque()  # tuples (kind, progress before it, message)
+        self.progress_message = None  # the latest progress that isn't played yet
+        self.last_progress = 0.0
+        self.thread = threading.Thread(target=self.run, name="notifier", daemon=True)
+        self.thread.start()
+
+    def notify(self, message):
+        self.put(_EVENT, message)
+
+    def progress(self, message):
+        # only the latest progress is kept, so a fast loop takes no more room
+        # while a message is being played
+        with self.condition:
+            self.progress_message = message
+            self.condition.notify()
+
+    def put(self, kind, message):
+        with self.condition:
+            self.events.append((kind, self.progress_message, message))
+            self.progress_message = None
+            self.condition.notify()
+
+    def close(self):
+        # plays what's left and stops
+        self.put(_STOP, None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.events:
+                        (kind, progress, message) = self.events.popleft()
+                        break
+                    timeout = None
+                    if self.progress_message is not None:
+                        timeout = self.last_progress + self.interval - time.monotonic()
+                        if timeout <= 0:
+                            (kind, progress, message) = (None, self.progress_message, None)
+                            self.progress_message = None
+                            break
+                    self.condition.wait(timeout)
+            if progress is not None:
+                self.play_safely(progress)
+                self.last_progress = time.monotonic()
+            if kind == _STOP:
+                return
+            if kind == _EVENT:
+                self.play_safely(message)
+
+    def play_safely(self, message):
+        try:
+            self.play(message)
+        except Exception as e:
+            logging.error(f"Error playing notification '{message}': {e}")
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+import logging
+import random
+import threading
+import time
+
+
+#retrying transfers from a card: the timeouts follow the throughput measured
+#so far in the session, the pauses between attempts grow up to a cap (with a
+#random part, so parallel transfers don't retry in lockstep), and once many
+#attempts in a row have failed the card is taken to be gone (e.g. the camera
+#was switched off), which ends the session instead of retrying every file
+
+#attempts per file
+_ATTEMPTS = 5
+
+#pause after the first failed attempt, doubled after every next one up to
+#_MAX_SLEEP; the actual pause is a random value between half and all of it
+_SLEEP = 1.0
+_MAX_SLEEP = 15.0
+
+#timeouts in seconds for reaching the card and for the longest silence
+#during a transfer; once the throughput is known, the read timeout is
+#shortened to _SLACK times the time a block takes, but not below _MIN_READ_TIMEOUT
+_CONNECT_TIMEOUT = 5.0
+_READ_TIMEOUT = 10.0
+_MIN_READ_TIMEOUT = 2.0
+
+#a transfer is cut off (and resumed by the next attempt) when it takes _SLACK
+#times longer than expected at the measured throughput, with a minimum of
+#_MIN_DEADLINE seconds
+_SLACK = 4.0
+_MIN_DEADLINE = 10.0
+
+#weight of the last transfer in the moving average of the throughput
+_WEIGHT = 0.3
+
+#failed attempts in a row, over all files, after which the card is taken to be gone
+_BREAKER = 6
+
+
+class CardGone(Exception):
+    pass
+
+
+class Policy:
+    # the retry policy of one session with a card, shared by all parallel
+    # transfers; the 'circuit breaker' opens after _BREAKER failed attempts
+    # in a row, or when trip() is called, after which every attempt raises
+    # CardGone right away
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.throughput = None  # bytes per second
+        self.failures = 0
+        self.gone = threading.Event()
+
+    def is_open(self):
+        return self.gone.is_set()
+
+    def check(self):
+        if self.gone.is_set():
+            raise CardGone(f"'{self.name}' is gone")
+
+    def trip(self, reason):
+        if not self.gone.is_set():
+            logging.error(f"Giving up on '{self.name}': {reason}")
+            self.gone.set()
+
+    def timeout(self, block_size):
+        # returns a tuple (connect, read) for requests
+        with self.lock:
+            throughput = self.throughput
+        if not throughput:
+            return (_CONNECT_TIMEOUT, _READ_TIMEOUT)
+        read = min(max(_SLACK * block_size / throughput, _MIN_READ_TIMEOUT), _READ_TIMEOUT)
+        return (_CONNECT_TIMEOUT, read)
+
+    def deadline(self, size):
+        # returns the time.perf_counter() by which transferring 'size' bytes
+        # should be done, or None as long as the throughput isn't known
+        with self.lock:
+            throughput = self.throughput
+        if not throughput or size is None:
+            return None
+        return time.perf_counter() + max(_SLACK * size / throughput, _MIN_DEADLINE)
+
+    def measure(self, size, seconds):
+        # adds a transfer of 'size' bytes to the throughput
+        if size <= 0 or seconds <= 0:
+            return
+        with self.lock:
+            throughput = size / seconds
+            self.throughput = throughput if self.throughput is None else _WEIGHT * throughput + (1 - _WEIGHT) * self.throughput
+
+    def backoff(self, attempt):
+        sleep = min(_SLEEP * 2 ** attempt, _MAX_SLEEP)
+        return random.uniform(sleep / 2, sleep)
+
+    def run(self, transfer, description):
+        # calls transfer() until it doesn't raise an exception; returns a tuple
+        # of its result and the number of retries
+        for attempt in range(_ATTEMPTS):
+            self.check()
+            try:
+                result = transfer()
+            except CardGone:
+                raise
+            except Exception as e:
+                self.record_failure(description, e)
+                self.check()
+                if attempt + 1 < _ATTEMPTS:
+                    sleep = self.backoff(attempt)
+                    logging.warning(f"Sleeping {sleep:.1f} seconds because of error trying to {description} ({e}).")
+                    # the pause is cut short when the circuit opens meanwhile
+                    self.gone.wait(sleep)
+                else:
+                    logging.warning(f"Error trying to {description} ({e}).")
+            else:
+                self.record_success()
+                return (result, attempt)
+        logging.critical(f"Tried {_ATTEMPTS} times to {description}")
+        raise Exception(f"Gave up trying to {description}")
+
+    def record_failure(self, description, error):
+        # counts a failed attempt towards the circuit breaker; also for
+        # requests that are tried only once (e.g. sizes and thumbnails), so a
+        # card that is switched off meanwhile ends the session just as quickly
+        with self.lock:
+            self.failures += 1
+            failures = self.failures
+        if failures >= _BREAKER:
+            self.trip(f"{failures} failed attempts in a row, the last one to {description} ({error})")
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
@@ -1,19 +1,29 @@
 #!/usr/bin/python3
 import beepy
-import datetime
-import exifread
-import glob
+import concurrent.futures
+import ezexif
+import ezhistory
+import ezingest
+import ezjournal
+import ezmetrics
+import eznotify
+import ezretry
+import ezstatus
+import eztransfer
+import ezupload
+import ezwatch
+import html
 import logging
 import nmcli
 import os
 import os.path
+import re
 import requests
-import shutil
-import subprocess
+import socket
 import time
 import traceback
 import urllib.parse
-from bs4 import BeautifulSoup
+import urllib3
 
 
 #all SD cards should be configured with ssid "ez Share X100S", where 'X100S' is variable and 
@@ -21,13 +31,89 @@ from bs4 import BeautifulSoup
 #all SD cards should be configured with the same password:
 _PASSWORD = "Rodinal9"
 
-#for each camera a text file is stored that lists all ever downloaded filenames
-_HISTORY = os.path.expanduser("~/.ezshare-raspberry-history")
-os.makedirs(_HISTORY, exist_ok=True)
-
 #temporary workspace while downloaden/uploading files
 _TEMP = "/home/vic/upload"
-os.makedirs(_TEMP, exist_ok=True)
+
+#partially downloaded files are kept here, so a later attempt can resume them;
+#it's next to _TEMP and not inside it, as gphotos-uploader-cli pushes
+#everything in _TEMP, and on the same file system, so complete files are
+#moved into their album without copying; this folder is never cleaned up
+_PARTIAL = f"{_TEMP}.partial"
+
+#downloads are streamed to disk in blocks of this size
+_CHUNK_SIZE = 64 * 1024
+
+#every this many bytes, a download is synced to disk and its offset is
+#written to the journal (see ezjournal.py)
+_SYNC_SIZE = 8 * 1024 * 1024
+
+#address of the card once connected to its wifi (domain: ezshare.card)
+_CARD = "http://192.168.4.1/"
+
+#the listing of the card is scanned with these instead of a full html parser
+_THUMBNAIL = re.compile(r"""thumbnail\?([^"'\s>]+)""")
+#(the link to the next page must be inside div#post, the links after it are not)
+_NEXT_PAGE = re.compile(r"""<div[^>]*\bid=["']?post(?=["'\s>])[^>]*>(?:(?!</div>).)*?<a[^>]*\bhref=["']?([^"'\s>]+)""", re.DOTALL | re.IGNORECASE)
+
+#number of files that are downloaded in parallel; all downloads share one
+#pool of keep-alive connections to the card
+_WORKERS = 3
+
+#with _PREVIEW, the thumbnails of the new files are downloaded first, in
+#parallel, into an album '{date} {camera} preview'; they're a few KB each, so
+#every shot is staged within seconds, even if the card goes out of range
+#before its full files are in; with _PREVIEW_ONLY, the full files are left
+#for the USB path (usbdcim.py) and only the thumbnails are downloaded
+_PREVIEW = False
+_PREVIEW_ONLY = False
+
+#cards with a weaker signal (0-100, as reported by nmcli) aren't connected to
+_MIN_SIGNAL = 25
+
+#right after listing, the first bytes of the first new file are downloaded to
+#measure the throughput of the link (they're kept for the download itself);
+#the files that can't be downloaded within _MAX_SESSION seconds at that
+#throughput are left for a later visit, and if the link is slower than
+#_MIN_THROUGHPUT bytes per second, the whole session is
+_PROBE_SIZE = 256 * 1024
+_MAX_SESSION = 10 * 60
+_MIN_THROUGHPUT = 50 * 1024
+
+#a card that was (partly) left for a later visit is skipped for _DEFER seconds,
+#unless its signal has improved by _BETTER_SIGNAL meanwhile
+_DEFER = 5 * 60
+_BETTER_SIGNAL = 10
+
+#outcomes of sync_card(): all new files are downloaded, only the ones that
+#fit in _MAX_SESSION, or none because the link is too bad
+ADMITTED = "admitted"
+LIMITED = "limited"
+DEFERRED = "deferred"
+
+_deferred = {}  # ssid -> tuple (time, signal) of cards that were left for a later visit
+
+#cards are looked for when NetworkManager finds a new wifi network (see
+#ezwatch.py), and otherwise every _MIN_SCAN seconds, growing up to _MAX_SCAN
+#while nothing shows up; a card isn't visited again within _COOLDOWN seconds
+_MIN_SCAN = 10
+_MAX_SCAN = 60
+_COOLDOWN = 30
+
+_visited = {}  # ssid -> time of the last visit
+
+#beeps are played on a background thread (see eznotify.py)
+_notifier = eznotify.Notifier(lambda sound: beepy.beep(sound=sound))
+
+#with a second interface (a USB wifi dongle 'wlan1', or 'wlan0' while 'eth0'
+#keeps the uplink), the cards are connected on _CARD_INTERFACE only and the
+#requests to the card are bound to it: the home network stays up on the other
+#interface, and uploading goes on while the cards are being read; with None,
+#the one wifi interface switches between the cards and the home network
+_CARD_INTERFACE = None
+
+#the progress of a running session is served on this port of localhost (see
+#ezstatus.py); None for no server
+_STATUS_PORT = 8421
 
 
 logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d %(funcName)s] %(message)s', datefmt='%Y-%m-%d:%H:%M:%S', level=logging.DEBUG)
@@ -36,66 +122,85 @@ def main():
 
     try:
 
+        os.makedirs(_TEMP, exist_ok=True)
+        os.makedirs(_PARTIAL, exist_ok=True)
         home_network = find_active_connection()
+        ezhistory.compact()
+        if _STATUS_PORT is not None:
+            ezstatus.serve(_STATUS_PORT)
+        watcher = ezwatch.Watcher(_MIN_SCAN, _MAX_SCAN)
+        watcher.watch_networkmanager()
+        woken = False
 
         #endless polling loop
         while True: 
 
-            ez_ssid = find_first_active_ezshare_ssid()
+            start = time.perf_counter()
+            # after an event from NetworkManager, its scan results are fresh
+            ez_ssids = find_active_ezshare_ssids(rescan=not woken)
 
-            if ez_ssid:
+            if ez_ssids:
 
-                beepy.beep(sound="success")
+                _notifier.notify("success")
+                ezmetrics.start_session("ezshare")
+                ezmetrics.add_phase("scan", time.perf_counter() - start)
 
                 try:
 
                     #import pdb; pdb.set_trace()
 
-                            
-                    camera_name = get_camera_name(ez_ssid)
                     home_network = find_active_connection()
-                    downloaded_files = list_downloaded_files(camera_name)
-                    connect_to_ezshare_ssid(ez_ssid)
-                    filenames = get_list_of_filenames_on_camera()
-                    
-                    for (directory, filename) in filenames:
-
-                        if filename not in downloaded_files:
-
-                            download_result = download(camera_name, directory, filename)
-                            
-                            if download_result:
-                                beepy.beep(sound="ping")
-                                add_to_list_of_downloaded_files(camera_name, filename)
+                    # files are uploaded once back on the home network, or
+                    # right away if it stays up on another interface
+                    uploader = ezupload.Uploader(_TEMP)
+                    if _CARD_INTERFACE:
+                        uploader.start()
+
+                    # all cards in range are visited back-to-back
+                    for (ez_ssid, signal) in ez_ssids:
+
+                        try:
+                            admission = sync_card(ez_ssid, uploader)
+                        except Exception as e:
+                            logging.error(f"There's a problem processing '{ez_ssid}': {e}")
+                        else:
+                            if admission == ADMITTED:
+                                _deferred.pop(ez_ssid, None)
                             else:
-                                beepy.beep(sound="error")
+                                logging.info(f"'{ez_ssid}' is {admission}, trying again in {_DEFER} seconds or with a better signal")
+                                _deferred[ez_ssid] = (time.time(), signal)
+                        _visited[ez_ssid] = time.time()
 
-                    connect_to_home_network(home_network)
-                    beepy.beep(sound="ready")
-                    upload_result = upload_to_photos(camera_name)
+                        if not uploader.wait_for_space():
+                            logging.warning("No more disk space for files waiting to be uploaded, the rest is for next time")
+                            break
+
+                    with ezmetrics.phase("home"):
+                        connect_to_home_network(home_network)
+                    _notifier.notify("ready")
+                    with ezmetrics.phase("upload"):
+                        upload_result = uploader.finish()
+                    ezmetrics.end_session(upload_result)
 
                     if upload_result:
 
-                        delete_files()
                         logging.info("Success!")
 
                     else:
 
                         logging.warning("Failure!")
 
-                    logging.debug("Sleeping")
-                    nmcli.device.wifi_rescan()
-                    time.sleep(30)  # wait an extra 10 seconds before polling again
-                    nmcli.device.wifi_rescan()
-
                 except Exception as e:
 
                     if home_network:
                         connect_to_home_network(home_network)
-                    logging.error(f"There's a problem processing '{ez_ssid}': {e}")
+                    logging.error(f"There's a problem processing {ez_ssids}: {e}")
+                    ezmetrics.end_session(False)
 
-            logging.debug("Sleeping")
-            time.sleep(10)  # poll every 10 seconds for active cards
+                # another card may show up soon
+                watcher.reset()
+
+            woken = watcher.wait()
                 
 
     #execute this code if CTRL + C is used to kill python script
@@ -116,168 +221,509 @@ def main():
 def find_active_connection():
     connections = nmcli.connection()
     for connection in connections:
-        if connection.device != "--":
+        if connection.device not in ("--", _CARD_INTERFACE):
             logging.info(f"'{connection.name}' is the current network connection")
             return connection.name
     else:
         logging.error("There seems to be no active network connection!")
 
 
-def find_first_active_ezshare_ssid():
-
-    devices = nmcli.device.wifi(rescan=True)  # rescan doesn't really seem to work
+def find_active_ezshare_ssids(rescan=True):
+    # returns tuples (ssid, signal) of all cards in range, the ones expected to
+    # have the most new files (weighed by their signal strength) first; cards
+    # with a weak signal, or that were visited or deferred recently, are left out
+    devices = nmcli.device.wifi(ifname=_CARD_INTERFACE, rescan=rescan)  # rescan doesn't really seem to work
+    signals = {}
     for device in devices:
         if "ez Share" in device.ssid:
-            logging.info(f"'{device.ssid}' is online!")
-            return device.ssid
-
-
-def get_camera_name(ssid):
-    camera_name = ssid.split("ez Share", 1)[1].lstrip()
-    if camera_name:
-        logging.info(f"Camera name is: '{camera_name}'")
-    else:
-        camera_name = "ezshare"
-        logging.warning(f"No camera name, using default: '{camera_name}'")
-    return camera_name
+            # a card can be listed more than once, keep its best signal
+            signals[device.ssid] = max(device.signal, signals.get(device.ssid, 0))
+    ranking = {}
+    for (ssid, signal) in signals.items():
+        if signal < _MIN_SIGNAL:
+            logging.info(f"'{ssid}' is online, but its signal is too weak ({signal})")
+            continue
+        if time.time() < _visited.get(ssid, 0) + _COOLDOWN:
+            logging.debug(f"'{ssid}' is online, but was just visited")
+            continue
+        if ssid in _deferred:
+            (deferred_time, deferred_signal) = _deferred[ssid]
+            if time.time() < deferred_time + _DEFER and signal < deferred_signal + _BETTER_SIGNAL:
+                logging.info(f"'{ssid}' is online, but deferred (signal {signal})")
+                continue
+        expected = ezhistory.expected_new_files(ezingest.get_camera_name(ssid, "ezshare"))
+        ranking[(ssid, signal)] = expected * signal
+        logging.info(f"'{ssid}' is online! (signal {signal}, expecting {expected:.0f} new files)")
+    return sorted(ranking, key=ranking.get, reverse=True)
+
+
+def sync_card(ez_ssid, uploader):
+    # connects to the card and downloads its new files, staging them for
+    # 'uploader'; returns ADMITTED, LIMITED or DEFERRED (see admit())
+    camera_name = ezingest.get_camera_name(ez_ssid, "ezshare")
+    ezmetrics.add_camera(camera_name)
+
+    # the retries of all transfers from this card, and whether it's gone
+    policy = ezretry.Policy(camera_name)
+
+    # the history is closed (and committed) before the journal is removed
+    with ezjournal.Journal("ezshare", camera_name) as journal, ezhistory.History(camera_name) as history:
+
+        journal.replay(history)
+
+        with ezmetrics.phase("connect"):
+            connect_to_ezshare_ssid(ez_ssid)
+
+        with create_session() as session:
+
+            source = CardSource(session)
+            with ezmetrics.phase("listing"):
+                files = source.list(history, journal)
+            new_filenames = [(directory, filename) for (directory, filename, size, taken) in files if not history.contains(directory, filename)]
+            history.set_states(new_filenames, ezhistory.DISCOVERED)
+
+            if _PREVIEW or _PREVIEW_ONLY:
+                # thumbnails of files that were previewed on an earlier visit aren't downloaded again
+                preview_filenames = [(directory, filename) for (directory, filename) in new_filenames
+                                     if history.get_state(directory, filename) == ezhistory.DISCOVERED]
+                with ezmetrics.phase("preview"):
+                    for (directory, filename, preview_result) in download_thumbnails(session, camera_name, preview_filenames, policy):
+                        if preview_result:
+                            history.set_state(directory, filename, ezhistory.PREVIEWED)
+                            uploader.add(preview_result)
+                # the previews are published right away, not with the first batch of full files
+                uploader.flush()
+                if _PREVIEW_ONLY:
+                    # the full files aren't added to the history, so the USB path still picks them up
+                    history.set_visit(len(preview_filenames))
+                    return ADMITTED
+
+            # only the files meant for wifi, in the order of eztransfer.py
+            new_filenames = [(directory, filename) for (directory, filename) in new_filenames if eztransfer.is_allowed(filename, "wifi")]
+            with ezmetrics.phase("sizes"):
+                sizes = get_sizes(session, new_filenames, policy)
+            sizes = dict(zip(new_filenames, sizes))
+            new_filenames = eztransfer.plan([(directory, filename, sizes[(directory, filename)], None) for (directory, filename) in new_filenames], "wifi")
+            history.set_visit(len(new_filenames))
+
+            with ezmetrics.phase("admission"):
+                (admission, new_filenames) = admit(session, new_filenames, sizes, policy)
+
+            with ezmetrics.phase("download"):
+
+                files = [(directory, filename, sizes[(directory, filename)], None) for (directory, filename) in new_filenames]
+                for (directory, filename, download_result) in ezingest.ingest(source, camera_name, files, history, policy, journal, uploader):
+
+                    if download_result or download_result is None:
+                        # staged, or a copy of a file that was downloaded before
+                        _notifier.progress("ping")
+                    else:
+                        _notifier.notify("error")
 
+                    if policy.is_open():
+                        logging.warning(f"Lost '{ez_ssid}', the rest is for next time")
+                        break
 
-def list_downloaded_files(camera_name):
-    filename = f"{_HISTORY}/{camera_name}.txt"
-    try:
-        file = open(filename)
-        lines = file.read().splitlines()
-        file.close()
-    except FileNotFoundError:
-        file = open(filename, "w")
-        logging.warning(f"Created empty file: '{filename}'")
-        lines = []
-        file.close()
-    logging.info(f"Number of images ever downloaded from '{camera_name}': {str(len(lines))}")
-    return lines
+            return admission
 
 
 def connect_to_ezshare_ssid(ssid):
     try:
         logging.info(f"Going to connect to '{ssid}'")
-        nmcli.device.wifi_connect(ssid=ssid, password=_PASSWORD)
+        nmcli.device.wifi_connect(ssid=ssid, password=_PASSWORD, ifname=_CARD_INTERFACE)
         logging.info(f"Connected to '{ssid}'")
     except Exception as e:
         logging.error(f"Error connecting to '{ssid}': {e}")
         raise e
+    if _CARD_INTERFACE:
+        set_never_default(ssid)
 
 
-def get_list_of_filenames_on_camera():
-    domain = "http://192.168.4.1/"  # domain: ezshare.card
-    url = domain + "mphoto"
-    # in this html, <img> elements represent the pictures on the SD card and 
-    # their @src attribute looks like this:
-    # thumbnail?fname=DSCF3479.JPG&fdir=103_FUJI&ftype=0&time=1389464558
-    # where the timestamp is not usable
-    # returning a list of tuples (dir, filename)
+def set_never_default(ssid):
+    # the card must not become the default route, that's the home network;
+    # the profile is only there once wifi_connect() made it (named after the
+    # ssid, unless that name was taken), so the change is reapplied to the
+    # connection it activated; if this fails, the card is read anyway
+    try:
+        for connection in nmcli.connection():
+            if connection.conn_type not in ("wifi", "802-11-wireless"):
+                continue
+            if nmcli.connection.show(connection.uuid).get("802-11-wireless.ssid") == ssid:
+                nmcli.connection.modify(connection.uuid, {"ipv4.never-default": "yes", "ipv6.never-default": "yes"})
+        nmcli.device.reapply(_CARD_INTERFACE)
+    except Exception as e:
+        logging.warning(f"Can't keep '{ssid}' from becoming the default route: {e}")
 
-    list_of_filenames = []
 
-    while True:
-        
+def create_session():
+    # one session for the whole visit to the card, so all requests reuse
+    # the same keep-alive connections instead of reconnecting for each file
+    session = requests.Session()
+    if _CARD_INTERFACE:
+        adapter = InterfaceAdapter(_CARD_INTERFACE, pool_connections=1, pool_maxsize=_WORKERS)
+    else:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=_WORKERS)
+    session.mount(_CARD, adapter)
+    return session
+
+
+class InterfaceAdapter(requests.adapters.HTTPAdapter):
+    # binds all connections to network interface 'interface' with SO_BINDTODEVICE,
+    # whatever the routing table says (allowed without root since Linux 5.7)
+
+    def __init__(self, interface, **kwargs):
+        self.interface = interface
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = urllib3.connection.HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_BINDTODEVICE, self.interface.encode())]
+        super().init_poolmanager(*args, **kwargs)
+
+
+class CardSource(ezingest.Source):
+    # the card over http (see ezingest.py), with one session for the whole visit
+
+    def __init__(self, session):
+        super().__init__(_TEMP, _PARTIAL, _WORKERS)
+        self.session = session
+
+    def list(self, history, journal):
+        # the sizes are asked separately, for the files that are new (see get_sizes())
+        return [(directory, filename, None, None) for (directory, filename) in get_list_of_filenames_on_camera(self.session, history, journal)]
+
+    def probe(self, directory, filename, filepath, policy):
+        return probe(self.session, f"{_CARD}DCIM/{directory}/{filename}", filepath, policy)
+
+    def fetch(self, directory, filename, filepath, policy, journal, size):
+        return fetch(self.session, f"{_CARD}DCIM/{directory}/{filename}", filepath, policy, journal, size)
+
+
+def get_list_of_filenames_on_camera(session, history, journal):
+    # the listing of the card is spread over pages; the pages before the one
+    # holding the first file that isn't in the history yet (the 'enumeration
+    # mark' of the previous visit) are skipped, unless the card has changed
+    # since; after an interrupted session, its listing is reused if the last
+    # page is still the same; returning a list of tuples (dir, filename)
+
+    listing = journal.get_listing()
+    if listing:
+        (key, list_of_filenames) = listing
         try:
-            logging.debug(f"Loading '{url}'")
-            with requests.get(url) as req:
-                html = req.content
+            (files, next_url) = get_page_of_filenames_on_camera(session, key["url"])
+            if not next_url and files == [tuple(file) for file in key["files"]]:
+                logging.info(f"The card hasn't changed since the interrupted session, reusing its list of {len(list_of_filenames)} files")
+                return list_of_filenames
         except Exception as e:
-            logging.error(f"Error downloading list of pictures from camera: {e}")
-            raise e
+            logging.warning(f"Can't check the list of the interrupted session: {e}")
+
+    mark = history.get_enumeration_mark()
+    if mark:
+        (url, mark_directory, mark_filename) = mark
+        logging.info(f"Resuming the list of files at '{url}'")
+    else:
+        url = _CARD + "mphoto"
+
+    pages = []  # list of tuples (url, list of tuples (dir, filename))
+
+    while True:
+
         try:
-            soup = BeautifulSoup(html, 'html.parser')
-            # parse image files
-            for img in soup.select('img'):
-                src = img.attrs['src']
-                query = urllib.parse.urlparse(src)
-                query_dict = urllib.parse.parse_qs(query.query)
-                filename = query_dict["fname"][0]
-                directory = query_dict["fdir"][0]
-                logging.debug(f"File on card: {query.query}")
-                list_of_filenames.append((directory, filename))
-            # parse for next page
-            next = soup.select('div#post a')
-            if next:
-                url = domain + next[0].attrs['href']
-                logging.info(f"There's another page at '{url}'")
-            else:
-                logging.info("This was the last page")
-                break
+            (files, next_url) = get_page_of_filenames_on_camera(session, url)
         except Exception as e:
-            logging.error(f"Error parsing list of picturs from camera: {e}")
+            if mark and not pages:
+                logging.warning(f"Can't resume at '{url}', listing all pages: {e}")
+                mark = None
+                url = _CARD + "mphoto"
+                continue
             raise e
-
-    logging.info(f"Retrieved a list of {len(list_of_filenames)} files that are on the card")
+        if mark and not pages and files[:1] != [(mark_directory, mark_filename)]:
+            logging.warning("The card has changed since the last visit, listing all pages")
+            mark = None
+            url = _CARD + "mphoto"
+            continue
+        pages.append((url, files))
+        if next_url:
+            url = next_url
+            logging.info(f"There's another page at '{url}'")
+        else:
+            logging.info("This was the last page")
+            break
+
+    (last_url, last_files) = pages[-1]
+
+    def _is_waiting(directory, filename):
+        # files that are never added to the history (RAW and video are left
+        # for USB, and with _PREVIEW_ONLY only the thumbnails are downloaded)
+        # mustn't hold the mark back, or the same pages are listed every visit
+        if _PREVIEW_ONLY:
+            return history.get_state(directory, filename) in (None, ezhistory.DISCOVERED)
+        return eztransfer.is_allowed(filename, "wifi") and not history.contains(directory, filename)
+
+    # next time, the list can be resumed at the first page with files waiting
+    for (url, files) in pages:
+        if any(_is_waiting(directory, filename) for (directory, filename) in files):
+            break
+    if files:
+        history.set_enumeration_mark(url, *files[0])
+
+    list_of_filenames = [file for (url, files) in pages for file in files]
+    logging.info(f"Retrieved a list of {len(list_of_filenames)} files from {len(pages)} pages")
+    journal.set_listing({"url": last_url, "files": last_files}, list_of_filenames)
     return list_of_filenames
 
 
-def download(camera_name, directory, filename):
-    # the file is downloaded, the date is fetched and the file is stored into
-    # {_TEMP}/{date} {camera_name}/{filename}
-    url = f"http://192.168.4.1/DCIM/{directory}/{filename}"
-    directory = f"{_TEMP}"
+def get_page_of_filenames_on_camera(session, url):
+    # in this html, <img> elements represent the pictures on the SD card and 
+    # their @src attribute looks like this:
+    # thumbnail?fname=DSCF3479.JPG&fdir=103_FUJI&ftype=0&time=1389464558
+    # where the timestamp is not usable; the link to the next page is the
+    # <a> in <div id="post">;
+    # returning a list of tuples (dir, filename) and the url of the next page
 
     try:
-        # download to {_TEMP}
-        filepath = f"{_TEMP}/{filename}"
-        logging.info(f"Going to download {url}")
-        sleep = 1
-        for attempt in range(10):
-            try:
-                logging.info(f"Downloading {url}")
-                with requests.get(url, allow_redirects=True, timeout=10.0) as req:
-                    blob = req.content
-                open(filepath, 'wb').write(blob)
-            except Exception as e:
-                time.sleep(sleep)  # pause hoping things will normalize
-                logging.warning(f"Sleeping {sleep} seconds because of error trying to download {url} ({e}).")
-                sleep *= 2
-            else:
-                logging.info(f"Downloaded '{filepath}'")
-                break  # no error caught
-        else:
-            logging.critical(f"Retried 10 times downloading {url}")
-        # fetch date
+        logging.debug(f"Loading '{url}'")
+        with session.get(url, timeout=10.0) as req:
+            req.raise_for_status()
+            page = req.text
+    except Exception as e:
+        logging.error(f"Error downloading list of pictures from camera: {e}")
+        raise e
+    try:
+        files = []
+        for query in _THUMBNAIL.findall(page):
+            params = dict(param.split("=", 1) for param in html.unescape(query).split("&") if "=" in param)
+            files.append((urllib.parse.unquote(params["fdir"]), urllib.parse.unquote(params["fname"])))
+        next = _NEXT_PAGE.search(page)
+        next_url = _CARD + html.unescape(next.group(1)) if next else None
+        logging.debug(f"Found {len(files)} files on '{url}'")
+        return (files, next_url)
+    except Exception as e:
+        logging.error(f"Error parsing list of picturs from camera: {e}")
+        raise e
+
+
+def admit(session, filenames, sizes, policy):
+    # measures the throughput of the card by downloading the first _PROBE_SIZE
+    # bytes of the first file, and estimates how long the session will take;
+    # returns ADMITTED and all 'filenames', LIMITED and the ones that fit in
+    # _MAX_SESSION, or DEFERRED and none of them
+    if not filenames:
+        return (ADMITTED, filenames)
+    (directory, filename) = filenames[0]
+    try:
+        throughput = measure_throughput(session, directory, filename, policy)
+    except Exception as e:
+        logging.warning(f"Error measuring the throughput of the card: {e}")
+        return (DEFERRED, [])
+    policy.measure(_PROBE_SIZE, _PROBE_SIZE / throughput)
+    # files of an unknown size are taken to be as big as the average one
+    known = [size for size in sizes.values() if size is not None]
+    average = sum(known) / len(known) if known else _PROBE_SIZE
+    total = sum(sizes[file] if sizes[file] is not None else average for file in filenames)
+    logging.info(f"The card sends {throughput / 1024:.0f} KB/s, {len(filenames)} files will take about {total / throughput:.0f} seconds")
+    if throughput < _MIN_THROUGHPUT:
+        return (DEFERRED, [])
+    if total / throughput <= _MAX_SESSION:
+        return (ADMITTED, filenames)
+    # the files are in the order of eztransfer.plan(), so the most wanted ones fit
+    admitted = []
+    budget = throughput * _MAX_SESSION
+    for file in filenames:
+        budget -= sizes[file] if sizes[file] is not None else average
+        if budget < 0:
+            break
+        admitted.append(file)
+    logging.info(f"Downloading {len(admitted)} of {len(filenames)} files, the rest is for a later visit")
+    return (LIMITED, admitted)
+
+
+def measure_throughput(session, directory, filename, policy):
+    # returns the bytes per second of downloading up to _PROBE_SIZE bytes of the
+    # file, which are kept in {_PARTIAL} to be resumed by the fetch (see ezingest.py), unless
+    # there's a partial download already
+    url = f"{_CARD}DCIM/{directory}/{filename}"
+    filepath = f"{_PARTIAL}/{directory}_{filename}"
+    keep = not os.path.exists(filepath)
+    start = time.perf_counter()
+    received = 0
+    with session.get(url, headers={"Range": f"bytes=0-{_PROBE_SIZE - 1}"}, stream=True, timeout=policy.timeout(_CHUNK_SIZE)) as req:
+        req.raise_for_status()
+        # a card that ignores the Range header sends the whole file
+        with open(filepath if keep else os.devnull, "wb") as file:
+            for chunk in req.iter_content(chunk_size=_CHUNK_SIZE):
+                file.write(chunk)
+                received += len(chunk)
+                if received >= _PROBE_SIZE:
+                    break
+    seconds = time.perf_counter() - start
+    if not received or not seconds:
+        raise Exception(f"Received {received} bytes in {seconds:.3f} seconds")
+    return received / seconds
+
+
+def get_sizes(session, filenames, policy):
+    # returns the sizes of the list of tuples (dir, filename), asking the card
+    # with _WORKERS parallel HEAD requests; a size is None if it's unknown
+
+    def _get_size(file):
+        (directory, filename) = file
         try:
-            f = open(filepath, 'rb')
-            tags = exifread.process_file(f)
-            datetime_tag = tags['EXIF DateTimeOriginal']
-            datetime_string = datetime_tag.values
-            datetime_object = datetime.datetime.strptime(datetime_string, '%Y:%m:%d %H:%M:%S')
-            date = datetime_object.strftime('%Y%m%d')
-            logging.info(f"Fetched the date from exif: '{date}'")
+            policy.check()
+            with session.head(f"{_CARD}DCIM/{directory}/{filename}", timeout=policy.timeout(_CHUNK_SIZE)) as req:
+                req.raise_for_status()
+                length = req.headers.get("Content-Length", "")
+            policy.record_success()
+            return int(length) if length.isdigit() else None
+        except ezretry.CardGone:
+            return None
         except Exception as e:
-            date = datetime.datetime.now().strftime('%Y%m%d')
-            logging.info(f"No date in exif, using today: '{date}'; because: {e}")
-        # move to album
-        album_directory = f"{_TEMP}/{date} {camera_name}"
+            logging.warning(f"Error getting the size of '{filename}': {e}")
+            # an error status is an answer, the card is still there
+            if not isinstance(e, requests.HTTPError):
+                policy.record_failure(f"get the size of '{filename}'", e)
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=_WORKERS) as executor:
+        return list(executor.map(_get_size, filenames))
+
+
+def download_thumbnails(session, camera_name, filenames, policy):
+    # downloads the thumbnails of the list of tuples (dir, filename) with
+    # _WORKERS parallel downloads; yields tuples (dir, filename, result) in
+    # the order of the list
+    with concurrent.futures.ThreadPoolExecutor(max_workers=_WORKERS) as executor:
+        results = executor.map(lambda file: download_thumbnail(session, camera_name, *file, policy), filenames)
+        for ((directory, filename), result) in zip(filenames, results):
+            yield (directory, filename, result)
+
+
+def download_thumbnail(session, camera_name, directory, filename, policy):
+    # the thumbnail is stored into {_TEMP}/{date} {camera_name} preview/{filename},
+    # which is returned (or False); the card makes thumbnails from the embedded
+    # preview of the picture, which may not have a date, in which case it's today;
+    # thumbnails aren't retried, the full file will follow anyway
+    url = f"{_CARD}thumbnail?fname={urllib.parse.quote(filename)}&fdir={urllib.parse.quote(directory)}&ftype=0"
+    try:
+        policy.check()
+        filepath = f"{_PARTIAL}/thumbnail_{directory}_{filename}"
+        try:
+            with session.get(url, timeout=policy.timeout(_CHUNK_SIZE)) as req:
+                req.raise_for_status()
+                thumbnail = req.content
+        except requests.RequestException as e:
+            # an error status is an answer, the card is still there
+            if not isinstance(e, requests.HTTPError):
+                policy.record_failure(f"download the thumbnail of '{filename}'", e)
+            raise
+        policy.record_success()
+        with open(filepath, "wb") as file:
+            file.write(thumbnail)
+        date = ezexif.get_date(thumbnail[:ezexif.HEAD_SIZE], filepath)
+        album_directory = f"{_TEMP}/{date} {camera_name} preview"
         os.makedirs(album_directory, exist_ok=True)
         final_filepath = f"{album_directory}/{filename}"
         os.replace(filepath, final_filepath)
-        logging.info(f"Moved '{filepath}' to '{final_filepath}'")
-        return True
+        logging.info(f"Downloaded the thumbnail of '{filename}' to '{final_filepath}'")
+        return final_filepath
+    except ezretry.CardGone:
+        return False
     except Exception as e:
-        logging.error(f"Error downloading '{filename}': {e}")
-        logging.error(traceback.format_exc())
+        logging.error(f"Error downloading the thumbnail of '{filename}': {e}")
         return False
 
 
-
-def add_to_list_of_downloaded_files(camera_name, filename):
-    history_filename = f"{_HISTORY}/{camera_name}.txt"
-    try:
-        file = open(history_filename, "a")
-        file.write(f"{filename}\n")
-        file.close()
-        logging.info(f"Added '{filename}' to '{history_filename}'")
-    except Exception as e:
-        logging.error(f"Error adding '{filename}' to '{history_filename}': {e}")
+def probe(session, url, filepath, policy):
+    # returns tuple (size, partial hash) of the file at 'url', fetching only its
+    # first and last ezhistory.HASH_BLOCK bytes; unless there's a partial
+    # download already, the first bytes are kept as the start of the download;
+    # returns None if the card doesn't support Range requests
+    block = ezhistory.HASH_BLOCK
+    policy.check()
+    with session.get(url, headers={"Range": f"bytes=0-{block - 1}"}, stream=True, timeout=policy.timeout(block)) as req:
+        if req.status_code != 206:
+            return None
+        head = req.content
+        size = int(req.headers["Content-Range"].rsplit("/", 1)[-1])
+    tail = b""
+    if size > block:
+        with session.get(url, headers={"Range": f"bytes=-{block}"}, stream=True, timeout=policy.timeout(block)) as req:
+            if req.status_code != 206:
+                return None
+            tail = req.content
+    if not os.path.exists(filepath):
+        with open(filepath, "wb") as file:
+            file.write(head)
+    return (size, ezhistory.partial_hash(size, head, tail))
+
+
+def fetch(session, url, filepath, policy, journal, known_size=None):
+    # streams 'url' to 'filepath' in blocks of _CHUNK_SIZE; if 'filepath' already
+    # holds a partial download, only the missing bytes are requested; every
+    # _SYNC_SIZE bytes, the offset that is safely on disk goes into 'journal';
+    # raises an exception if the result doesn't match the size the card reports,
+    # or if the transfer takes much longer than 'policy' expects;
+    # returns the size and, unless resumed, the first ezexif.HEAD_SIZE bytes
+    offset = os.path.getsize(filepath) if os.path.exists(filepath) else 0
+    if offset and offset == known_size:
+        return (offset, None)  # e.g. small files that were probed completely
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    start = time.perf_counter()
+    with session.get(url, headers=headers, allow_redirects=True, stream=True, timeout=policy.timeout(_CHUNK_SIZE)) as req:
+        if req.status_code == 416:
+            # Content-Range: bytes */{size}
+            total = req.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+            if total == str(offset):
+                return (offset, None)  # the partial file is complete already
+            # the partial file can't be resumed, start all over next attempt
+            os.remove(filepath)
+            raise Exception(f"Card refused to resume at byte {offset}")
+        req.raise_for_status()
+        if req.status_code == 206:
+            # Content-Range: bytes {offset}-{last}/{size}
+            total = req.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+            size = int(total) if total.isdigit() else None
+            mode = "ab"
+            logging.info(f"Resuming {url} at byte {offset}")
+        else:
+            # the card ignored the Range header (or there was nothing to resume)
+            length = req.headers.get("Content-Length", "")
+            size = int(length) if length.isdigit() else None
+            mode = "wb"
+        head = bytearray() if mode == "wb" else None
+        deadline = policy.deadline(size - offset if size is not None and mode == "ab" else size)
+        written = 0
+        try:
+            with open(filepath, mode) as file:
+                for chunk in req.iter_content(chunk_size=_CHUNK_SIZE):
+                    file.write(chunk)
+                    written += len(chunk)
+                    ezmetrics.add_bytes(len(chunk))
+                    if written % _SYNC_SIZE < len(chunk):
+                        file.flush()
+                        os.fsync(file.fileno())
+                        journal.set_offset(filepath, file.tell())
+                    if head is not None and len(head) < ezexif.HEAD_SIZE:
+                        head += chunk
+                    if deadline and time.perf_counter() > deadline:
+                        raise Exception(f"Too slow, cut off after {written} bytes")
+        finally:
+            policy.measure(written, time.perf_counter() - start)
+    received = os.path.getsize(filepath)
+    if size is not None and received != size:
+        raise Exception(f"Received {received} of {size} bytes")
+    return (received, head)
 
 
 def connect_to_home_network(name):
+    if _CARD_INTERFACE:
+        # the home network is still up, only the card is let go
+        try:
+            nmcli.device.disconnect(_CARD_INTERFACE)
+            logging.info(f"Disconnected '{_CARD_INTERFACE}' from the card")
+        except Exception as e:
+            logging.error(f"Error disconnecting '{_CARD_INTERFACE}': {e}")
+        return
     try:
         nmcli.connection.up(name)
         logging.info(f"Reconnected to home network '{name}'")
@@ -287,39 +733,5 @@ def connect_to_home_network(name):
         # and that seems to cause problems
 
 
-def upload_to_photos(camera_name):
-
-    def _upload_to_photos():
-        result = subprocess.run(["/home/vic/bin/gphotos-uploader-cli","push"], capture_output=True, text=True, env=dict(os.environ, GPHOTOS_CLI_TOKENSTORE_KEY=""))
-        out = result.stdout.split('\n')
-        for i in out:
-            if "0 with errors" in i:
-                logging.info("Pictures successfully uploaded to Google Photo's")
-                return True  # Success
-        else:
-            logging.error("Error uploading pictures to Google Photo's; here's Photo Uploader's output:")
-            for i in out:
-                logging.error(i)
-            return False  # Failure
-        
-    # check if there are files in the folder(s) for 'camera_name'
-    # if so, do an upload (this will upload other folders as well)
-    temp_dirs = os.listdir(_TEMP)
-    for temp_dir in temp_dirs:
-        if camera_name in temp_dir:
-        # return immedialely: all images are uploaded
-            return _upload_to_photos()
-    else:
-        logging.info("No pictures to upload")
-        return True
-
-
-def delete_files():
-    dirs = glob.glob(_TEMP + "/*")
-    for d in dirs:
-        shutil.rmtree(d)
-    logging.info(f"Deleted {len(dirs)} directories in {_TEMP}")
-
-
 if __name__ == "__main__":
     main()
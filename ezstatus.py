@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+import ezmetrics
+import http.server
+import json
+import logging
+import threading
+
+
+#the progress of the running session (see ezmetrics.get_progress()) is served
+#as json on http://localhost:<port>/, to tell whether a card is almost done or
+#better taken out and read over USB, e.g. `curl localhost:8421`; the server
+#only listens on the loopback interface
+_ADDRESS = "127.0.0.1"
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        logging.debug(f"Status request: {format % args}")
+
+    def do_GET(self):
+        progress = ezmetrics.get_progress()
+        body = json.dumps(progress if progress is not None else {"phases": []}, indent=1).encode() + b"\n"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StatusServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+
+def serve(port):
+    # serves the progress on 'port' from a background thread; returns the
+    # server, or None if it can't be started (the daemon works without it)
+    try:
+        server = StatusServer((_ADDRESS, port), Handler)
+    except Exception as e:
+        logging.warning(f"Can't serve the progress on port {port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="status", daemon=True).start()
+    logging.info(f"Serving the progress on http://localhost:{server.server_address[1]}/")
+    return server
@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+import logging
+import os.path
+
+
+#which files are transferred over which transport, and in what order; files
+#that are left out over wifi are collected later over USB, as they're never
+#added to the history
+
+#per transport: the extensions (lower case) that are transferred, and the
+#largest file in bytes (None for no limit)
+_TRANSPORTS = {
+    "wifi": {
+        "extensions": {".jpg", ".jpeg", ".heic", ".heif"},
+        "max_size": 50 * 1024 * 1024,
+    },
+    "usb": {
+        "extensions": {".jpg", ".jpeg", ".heic", ".heif",
+                       ".raf", ".nef", ".cr2", ".cr3", ".arw", ".dng", ".orf", ".rw2",
+                       ".mov", ".mp4"},
+        "max_size": None,
+    },
+}
+
+#files of the same name in the same folder (DSCF0001.JPG, DSCF0001.RAF) are
+#one shot; the files of a shot are transferred one after the other, and the
+#shots are ordered by their size, in steps of _SIZE_STEP bytes, and then newest
+#first: so pictures go before videos, and the last pictures before older ones
+_SIZE_STEP = 16 * 1024 * 1024
+
+
+def is_allowed(filename, transport):
+    # checks the extension only, for when the size isn't known yet
+    return os.path.splitext(filename)[1].lower() in _TRANSPORTS[transport]["extensions"]
+
+
+def plan(files, transport):
+    # 'files' is a list of tuples (directory, filename, size, time); a size
+    # may be None if it's unknown; if the times of all files are None, the
+    # order of the list (the order of the card) is taken to be the order the
+    # files were made in;
+    # returns the list of tuples (directory, filename) to be transferred over
+    # 'transport', in the order they should be transferred
+    max_size = _TRANSPORTS[transport]["max_size"]
+    shots = {}  # (directory, stem) -> list of tuples (position, directory, filename, size, time)
+    skipped = 0
+    for (position, (directory, filename, size, time)) in enumerate(files):
+        if not is_allowed(filename, transport) or (max_size is not None and size is not None and size > max_size):
+            skipped += 1
+            continue
+        stem = os.path.splitext(filename)[0]
+        shots.setdefault((directory, stem), []).append((position, directory, filename, size, time))
+    if skipped:
+        logging.info(f"Leaving {skipped} of {len(files)} files for another transport than {transport}")
+
+    def _order(shot):
+        # files of an unknown size go last
+        sizes = [size for (position, directory, filename, size, time) in shot]
+        steps = sum(sizes) // _SIZE_STEP if None not in sizes else float("inf")
+        times = [time for (position, directory, filename, size, time) in shot if time is not None]
+        newest = max(times) if times else max(position for (position, directory, filename, size, time) in shot)
+        return (steps, -newest)
+
+    return [(directory, filename)
+            for shot in sorted(shots.values(), key=_order)
+            for (position, directory, filename, size, time) in sorted(shot)]
@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+import ezhistory
+import ezmetrics
+import logging
+import os
+import os.path
+import re
+import subprocess
+import threading
+import time
+import traceback
+
+
+#gphotos-uploader-cli pushes everything in its SourceFolder, which must be the
+#_TEMP folder of the daemon (see ~/.gphotos-uploader-cli/config.hjson)
+_UPLOADER = "/home/vic/bin/gphotos-uploader-cli"
+
+#a push is started as soon as this many bytes are staged since the last one
+_BATCH_BYTES = 512 * 1024 * 1024
+
+#ingest waits while this many bytes are staged and not yet uploaded, so a big
+#card can't fill up the disk of the Pi
+_BUDGET_BYTES = 4 * 1024 * 1024 * 1024
+
+#seconds to wait before pushing again after a failed push
+_RETRY_SLEEP = 60
+
+#lines in the output of gphotos-uploader-cli: the summary at the end
+#("... 12 processed, 11 uploaded, 1 with errors") and the failures of files
+_SUMMARY = re.compile(r"\b(\d+) with errors")
+_FAILURE = re.compile(r"fail|error", re.IGNORECASE)
+
+
+class Uploader:
+    # uploads the files in 'temp' in batches on a background thread while
+    # ingest continues, and deletes them as soon as a push has succeeded;
+    # files are announced with add() when they're complete in their album;
+    # files already in 'temp' (left over from earlier sessions) are included,
+    # as gphotos-uploader-cli will push them too
+
+    def __init__(self, temp):
+        self.temp = temp
+        self.condition = threading.Condition()
+        self.pending = []  # files that are staged and not uploaded yet
+        self.pending_bytes = 0  # bytes staged since the last push
+        self.staged_bytes = 0  # bytes staged and not deleted yet
+        self.finishing = False
+        self.flushing = False  # a push is wanted, however few bytes are pending
+        self.success = True
+        self.thread = None
+        self.stopped = False  # the thread has ended, normally or not
+        self.failed_push = False  # the last push left files behind
+        for (directory, dirs, files) in os.walk(temp):
+            for file in files:
+                self.add(f"{directory}/{file}")
+        if self.pending:
+            logging.info(f"{len(self.pending)} files are still waiting to be uploaded")
+
+    def start(self):
+        # starts uploading; before that, files are only collected (e.g. while
+        # there's no internet connection)
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run, name="uploader", daemon=True)
+            self.thread.start()
+
+    def add(self, filepath):
+        size = os.path.getsize(filepath)
+        with self.condition:
+            self.pending.append((filepath, size))
+            self.pending_bytes += size
+            self.staged_bytes += size
+            self.condition.notify_all()
+
+    def flush(self):
+        # pushes what's pending without waiting for _BATCH_BYTES, e.g. the
+        # thumbnails of a preview, which are a few KB each
+        with self.condition:
+            self.flushing = True
+            self.condition.notify_all()
+
+    def has_space(self):
+        return self.staged_bytes < _BUDGET_BYTES
+
+    def wait_for_space(self):
+        # blocks while the staged files exceed the budget and uploading is
+        # going on; returns False if there's no space and no upload to wait
+        # for, or if pushes are failing (e.g. an expired token), as then the
+        # space may not come back during this session
+        with self.condition:
+            while not self.has_space():
+                if not self.thread or self.stopped or self.failed_push:
+                    return False
+                logging.info(f"{self.staged_bytes} bytes are waiting to be uploaded, pausing")
+                self.condition.wait()
+        return True
+
+    def finish(self):
+        # uploads whatever is left and waits for it; returns True if every
+        # push succeeded
+        self.start()
+        with self.condition:
+            self.finishing = True
+            self.condition.notify_all()
+        self.thread.join()
+        remove_empty_directories(self.temp)
+        return self.success
+
+    def run(self):
+        # if the thread stops unexpectedly, the files aren't uploaded, and
+        # nobody may wait for the space they take
+        try:
+            self.upload()
+        except Exception as e:
+            logging.error(f"The uploader has stopped: {e}")
+            logging.error(traceback.format_exc())
+            self.success = False
+        finally:
+            with self.condition:
+                self.stopped = True
+                self.condition.notify_all()
+
+    def upload(self):
+        while True:
+            with self.condition:
+                while not self.finishing and not self.flushing and self.pending_bytes < _BATCH_BYTES:
+                    self.condition.wait()
+                self.flushing = False
+                if not self.pending:
+                    if self.finishing:
+                        return
+                    continue
+                batch = self.pending
+                self.pending = []
+                self.pending_bytes = 0
+            # everything in the batch is complete before the push starts;
+            # only the files that failed are kept for the next push
+            with ezmetrics.phase("push"):
+                try:
+                    failed = push([filepath for (filepath, size) in batch])
+                except Exception as e:
+                    logging.error(f"Error running the Photo Uploader, the pictures will be retried: {e}")
+                    self.success = False
+                    failed = set(filepath for (filepath, size) in batch)
+            uploaded = [(filepath, size) for (filepath, size) in batch if filepath not in failed]
+            for (filepath, size) in uploaded:
+                try:
+                    os.remove(filepath)
+                except Exception as e:
+                    logging.error(f"Error deleting '{filepath}': {e}")
+            if uploaded:
+                logging.info(f"Deleted {len(uploaded)} uploaded files from {self.temp}")
+                try:
+                    ezhistory.set_uploaded([filepath for (filepath, size) in uploaded])
+                except Exception as e:
+                    logging.error(f"Error marking {len(uploaded)} files as uploaded in the history: {e}")
+            with self.condition:
+                self.staged_bytes -= sum(size for (filepath, size) in uploaded)
+                self.failed_push = bool(failed)
+                self.condition.notify_all()
+            if failed:
+                retry = [(filepath, size) for (filepath, size) in batch if filepath in failed]
+                with self.condition:
+                    self.pending = retry + self.pending
+                    self.pending_bytes += sum(size for (filepath, size) in retry)
+                    if self.finishing:
+                        # keep the files for the next session
+                        self.success = False
+                        return
+                time.sleep(_RETRY_SLEEP)
+
+
+def push(filepaths):
+    # runs gphotos-uploader-cli, following its output while it's running;
+    # returns the set of 'filepaths' that failed to upload: the ones mentioned
+    # in failure lines, or all of them if the failures can't be told apart
+    logging.info("Launching Photo Uploader...")
+    process = subprocess.Popen([_UPLOADER, "push"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=dict(os.environ, GPHOTOS_CLI_TOKENSTORE_KEY=""))
+    failed = set()
+    errors = None
+    for line in process.stdout:
+        line = line.rstrip()
+        summary = _SUMMARY.search(line)
+        if summary:
+            errors = int(summary.group(1))
+            logging.info(f"Photo Uploader: {line}")
+        elif _FAILURE.search(line):
+            logging.error(f"Photo Uploader: {line}")
+            failed.update(filepath for filepath in filepaths if filepath in line or os.path.basename(filepath) in line)
+        else:
+            logging.debug(f"Photo Uploader: {line}")
+    process.wait()
+    if errors == 0:
+        logging.info("Pictures successfully uploaded to Google Photo's")
+        return set()
+    if errors and len(failed) >= errors:
+        logging.error(f"Error uploading {len(failed)} pictures to Google Photo's, they'll be retried")
+        return failed
+    logging.error(f"Error uploading pictures to Google Photo's (exit code {process.returncode})")
+    return set(filepaths)
+
+
+def remove_empty_directories(temp):
+    for (directory, dirs, files) in os.walk(temp, topdown=False):
+        if directory != temp and not os.listdir(directory):
+            os.rmdir(directory)
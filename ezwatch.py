@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import subprocess
+import threading
+
+
+#instead of polling at a fixed interval, the daemons wait until something
+#happens that may be a card showing up: a file in the USB directory (inotify),
+#a file system that is mounted (/proc/self/mountinfo) or a wifi network that
+#NetworkManager has found (its AccessPointAdded signal on D-Bus); as long as
+#such events can be watched, the fallback polling interval grows while
+#nothing happens, from the 'minimum' to the 'maximum' of the Watcher
+
+#inotify events of a file appearing in the watched directory
+_IN_CREATE = 0x100
+_IN_MOVED_TO = 0x80
+_IN_ATTRIB = 0x4
+
+_MOUNTINFO = "/proc/self/mountinfo"
+
+_DBUS_MONITOR = ["dbus-monitor", "--system",
+                 "type='signal',interface='org.freedesktop.NetworkManager.Device.Wireless',member='AccessPointAdded'"]
+
+
+class Watcher:
+
+    def __init__(self, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = minimum
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.sources = 0  # number of event sources that are being watched
+
+    def wake(self):
+        self.event.set()
+
+    def reset(self):
+        # polls at the minimum interval again, e.g. after a session
+        self.interval = self.minimum
+
+    def wait(self):
+        # waits for an event or the polling interval; returns True on an event
+        logging.debug(f"Waiting for an event, or {self.interval:.0f} seconds")
+        woken = self.event.wait(self.interval)
+        self.event.clear()
+        with self.lock:
+            sources = self.sources
+        if woken:
+            self.interval = self.minimum
+        elif sources:
+            self.interval = min(self.interval * 2, self.maximum)
+        return woken
+
+    def add_source(self, count):
+        with self.lock:
+            self.sources += count
+
+    def watch_directory(self, directory):
+        # wakes up when a file appears in 'directory', or when something is
+        # mounted or unmounted anywhere (mounting a card over 'directory'
+        # doesn't show up in its inotify events)
+        fds = []
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1")
+            if libc.inotify_add_watch(fd, os.fsencode(directory), _IN_CREATE | _IN_MOVED_TO | _IN_ATTRIB) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch '{directory}'")
+            fds.append(fd)
+        except Exception as e:
+            logging.warning(f"Can't watch '{directory}' with inotify: {e}")
+        try:
+            mountinfo = open(_MOUNTINFO)
+            mountinfo.read()
+        except Exception as e:
+            logging.warning(f"Can't watch '{_MOUNTINFO}': {e}")
+            mountinfo = None
+        if not fds and not mountinfo:
+            return
+        self.add_source(1)
+        threading.Thread(target=self.run_directory, args=(fds, mountinfo), name="watch-directory", daemon=True).start()
+
+    def run_directory(self, fds, mountinfo):
+        poll = select.poll()
+        for fd in fds:
+            poll.register(fd, select.POLLIN)
+        if mountinfo:
+            poll.register(mountinfo, select.POLLPRI | select.POLLERR)
+        try:
+            while True:
+                for (fd, mask) in poll.poll():
+                    if mountinfo and fd == mountinfo.fileno():
+                        # the change is acknowledged by reading the file again
+                        mountinfo.seek(0)
+                        mountinfo.read()
+                        logging.debug("The mounted file systems have changed")
+                    else:
+                        os.read(fd, 64 * 1024)
+                        logging.debug("A file has appeared")
+                    self.wake()
+        except Exception as e:
+            logging.error(f"Stopped watching for files and mounts: {e}")
+            self.add_source(-1)
+
+    def watch_networkmanager(self):
+        # wakes up when NetworkManager finds a new wifi network
+        try:
+            process = subprocess.Popen(_DBUS_MONITOR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        except Exception as e:
+            logging.warning(f"Can't watch NetworkManager for new wifi networks: {e}")
+            return
+        self.add_source(1)
+        threading.Thread(target=self.run_networkmanager, args=(process,), name="watch-networkmanager", daemon=True).start()
+
+    def run_networkmanager(self, process):
+        for line in process.stdout:
+            if "member=AccessPointAdded" in line:
+                logging.debug("NetworkManager has found a wifi network")
+                self.wake()
+        logging.error(f"Stopped watching NetworkManager (exit code {process.wait()})")
+        self.add_source(-1)
@@ -1,41 +1,74 @@
 #!/usr/bin/env python
-import datetime
-import exifread
+import ezhistory
+import ezingest
+import ezjournal
+import ezmetrics
+import eznotify
+import ezretry
+import ezstatus
+import eztransfer
+import ezupload
+import ezwatch
 import getpass
 import glob
 import logging
 import os
 import os.path
-import requests
-import shutil
 import subprocess
 import time
 import traceback
-import urllib.parse
 
 
 #all USB drives should contain a root file "ez Share X100S", where 'X100S' is variable and 
 #identifies your camera; this string will be replicated in the album names
 #(if the USB drive is actually an ez Share SD card, use the same name !!)
 
-#for each camera a text file is stored that lists all ever downloaded filenames
-_HISTORY = os.path.expanduser("~/.ezshare-raspberry-history")
-os.makedirs(_HISTORY, exist_ok=True)
-
 #temporary workspace while downloaden/uploading files
 #this file is also configured in /home/vic/.gphotos-uploader-cli/config.hjson
 _TEMP = "/home/vic/Pictures/upload"
-os.makedirs(_TEMP, exist_ok=True)
+
+#files are copied into this folder first, and moved into their album when
+#complete; it's next to _TEMP and not inside it, as gphotos-uploader-cli
+#pushes everything in _TEMP, and on the same file system, so the move doesn't
+#copy the file again
+_PARTIAL = f"{_TEMP}.partial"
+
+#number of files that are copied in parallel, to keep the card reader busy
+_WORKERS = 4
+
+#files are copied in blocks of this size, to be able to cut off a copy that
+#takes too long (see ezretry.py)
+_CHUNK_SIZE = 8 * 1024 * 1024
+
+#speech is played on a background thread (see eznotify.py)
+_notifier = eznotify.Notifier(lambda text: subprocess.run(["spd-say", "--wait", text]))
 
 #path where the find automounted sd cards
 #(automount is configured in /etc/fstab)
 _USB = "/home/vic/Pictures/USB"
 
+#cards are looked for when something is mounted or shows up in _USB (see
+#ezwatch.py), and otherwise every _MIN_SCAN seconds, growing up to _MAX_SCAN
+#while nothing happens
+_MIN_SCAN = 10
+_MAX_SCAN = 60
+
+#the progress of a running session is served on this port of localhost (see
+#ezstatus.py); None for no server
+_STATUS_PORT = 8422
+
 logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d %(funcName)s] %(message)s', datefmt='%Y-%m-%d:%H:%M:%S', level=logging.INFO)
 
 def main():
 
     logging.info(f"Running as {getpass.getuser()}")
+    os.makedirs(_TEMP, exist_ok=True)
+    os.makedirs(_PARTIAL, exist_ok=True)
+    ezhistory.compact()
+    if _STATUS_PORT is not None:
+        ezstatus.serve(_STATUS_PORT)
+    watcher = ezwatch.Watcher(_MIN_SCAN, _MAX_SCAN)
+    watcher.watch_directory(_USB)
 
     try:
 
@@ -48,52 +81,74 @@ def main():
 
             if usb_name:
 
-                os.system('spd-say "Starting to read card"')
+                _notifier.notify("Starting to read card")
+                ezmetrics.start_session("usbdcim")
 
                 try:
 
-                    camera_name = get_camera_name(usb_name)
-                    downloaded_files = list_downloaded_files(camera_name)
-                    filenames = get_list_of_filenames_on_camera(usb_path)
-                    
-                    count = 0
-                    for (path, filename) in filenames:
+                    camera_name = ezingest.get_camera_name(usb_name, "usbdcim")
+                    ezmetrics.add_camera(camera_name)
+                    # uploading starts while the card is still being read
+                    uploader = ezupload.Uploader(_TEMP)
+                    uploader.start()
+                    # the retries of all copies from this card, and whether it's gone
+                    policy = ezretry.Policy(camera_name)
+
+                    # the history is closed (and committed) before the journal is removed
+                    with ezjournal.Journal("usbdcim", camera_name) as journal, ezhistory.History(camera_name) as history:
+
+                        journal.replay(history)
 
-                        count += 1
-                        if filename not in downloaded_files:
+                        source = MountSource(usb_path)
+                        with ezmetrics.phase("listing"):
+                            files = source.list(history, journal)
 
-                            logging.info(f"Progress {count} of {len(filenames)}")
-                            download_result = download(camera_name, path, filename)
-                            
-                            if download_result:
-                                os.system(f'spd-say "{count}"')
-                            else:
-                                os.system('spd-say "an error has occurred"')
+                        # the files are copied in the order of eztransfer.py
+                        new_files = {(directory, filename): (directory, filename, size, mtime) for (directory, filename, size, mtime) in files
+                                     if not history.contains(directory, filename, size)}
+                        new_filenames = eztransfer.plan(list(new_files.values()), "usb")
+                        history.set_states(new_filenames, ezhistory.DISCOVERED)
 
-                    unmount(usb_path)
-                    os.system('spd-say "detach your card"')
-                    upload_result = upload_to_photos(camera_name)
+                        with ezmetrics.phase("download"):
 
-                    if upload_result:
+                            count = 0
+                            for (directory, filename, download_result) in ezingest.ingest(source, camera_name, [new_files[file] for file in new_filenames], history, policy, journal, uploader):
 
-                        delete_files()
-                        for (path, filename) in filenames:
-                            add_to_list_of_downloaded_files(camera_name, filename)
-                        logging.info("Success!")
+                                if download_result or download_result is None:
+                                    # staged, or a copy of a file that was downloaded before
+                                    count += 1
+                                    _notifier.progress(f"{count} files done")
+                                elif policy.is_open():
+                                    _notifier.notify("the card is gone")
+                                    break
+                                else:
+                                    _notifier.notify("an error has occurred")
 
-                    else:
+                        unmount(usb_path)
+                        _notifier.notify("detach your card")
+                        # the uploader marks files as uploaded in the history
+                        # database, which it can't while a batch is pending here
+                        history.commit()
+                        with ezmetrics.phase("upload"):
+                            upload_result = uploader.finish()
+                        ezmetrics.end_session(upload_result)
 
-                        logging.warning("Failure!")
+                        if upload_result:
 
-                    logging.info("Sleeping")
-                    time.sleep(10)  # wait an extra 10 seconds before polling again
+                            logging.info("Success!")
+
+                        else:
+
+                            logging.warning("Failure!")
 
                 except Exception as e:
 
                     logging.error(f"There's a problem processing '{usb_path}': {e}")
+                    ezmetrics.end_session(False)
 
-            logging.info("Sleeping")
-            time.sleep(10)  # poll every 10 seconds for active cards
+                watcher.reset()
+
+            watcher.wait()
                 
 
     #execute this code if CTRL + C is used to kill python script
@@ -119,109 +174,98 @@ def find_first_mounted_ezshare_usb_name():
         return None, None
 
 
-def get_camera_name(ssid):
-    camera_name = ssid.split("ez Share", 1)[1].lstrip()
-    if camera_name:
-        logging.info(f"Camera name is: '{camera_name}'")
-    else:
-        camera_name = "usbdcim"
-        logging.warning(f"No camera name, using default: '{camera_name}'")
-    return camera_name
+class MountSource(ezingest.Source):
+    # the card mounted at 'usb_path' (see ezingest.py)
 
+    def __init__(self, usb_path):
+        super().__init__(_TEMP, _PARTIAL, _WORKERS)
+        self.usb_path = usb_path
 
-def list_downloaded_files(camera_name):
-    filename = f"{_HISTORY}/{camera_name}.txt"
-    try:
-        file = open(filename)
-        lines = file.read().splitlines()
-        file.close()
-    except FileNotFoundError:
-        file = open(filename, "w")
-        logging.warning(f"Created empty file: '{filename}'")
-        lines = []
-        file.close()
-    logging.info(f"Number of images ever downloaded from '{camera_name}': {str(len(lines))}")
-    return lines
+    def list(self, history, journal):
+        return get_list_of_filenames_on_camera(self.usb_path, journal)
+
+    def get_path(self, directory, filename):
+        return f"{self.usb_path}/DCIM/{directory}/{filename}"
 
+    def probe(self, directory, filename, filepath, policy):
+        policy.check()
+        return ezhistory.partial_hash_of_file(self.get_path(directory, filename))
 
-def get_list_of_filenames_on_camera(usb_path):
-    # returning a list of tuples (path, filename)
+    def fetch(self, directory, filename, filepath, policy, journal, size):
+        # a copy starts over on every attempt, it's fast enough
+        file = self.get_path(directory, filename)
+        try:
+            copy(file, filepath, policy)
+        except Exception:
+            # a card that is pulled out takes its mount point along
+            if not os.path.isdir(os.path.dirname(file)):
+                policy.trip(f"'{os.path.dirname(file)}' has disappeared")
+            raise
+        return (os.path.getsize(filepath), None)
+
+
+def get_list_of_filenames_on_camera(usb_path, journal):
+    # returning a list of tuples (directory, filename, size, mtime) of all
+    # files, eztransfer.py decides which ones are copied; after an interrupted
+    # session, its listing is reused if none of the folders has changed
+
+    key = [[directory, os.stat(directory).st_mtime_ns] for directory in sorted(glob.glob(f"{usb_path}/DCIM/*/"))]
+    listing = journal.get_listing()
+    if listing and listing[0] == key:
+        logging.info(f"The card hasn't changed since the interrupted session, reusing its list of {len(listing[1])} files")
+        return listing[1]
 
     list_of_filenames = []
-    files = glob.glob(f"{usb_path}/DCIM/*/*.JPG")
+    files = [file for file in glob.glob(f"{usb_path}/DCIM/*/*") if os.path.isfile(file)]
 
     for file in files:
 
-        filename = file.split('/')[-1]
-        path = file.split(filename)[0]
         logging.info(f"File on card: {file}")
-        list_of_filenames.append((path, filename))
+        stat = os.stat(file)
+        # the DCIM subdirectory of the file, e.g. '103_FUJI'
+        directory = os.path.basename(os.path.dirname(file))
+        list_of_filenames.append((directory, os.path.basename(file), stat.st_size, stat.st_mtime))
 
     logging.info(f"Retrieved a list of {len(list_of_filenames)} files that are on the card")
+    journal.set_listing(key, list_of_filenames)
     return list_of_filenames
 
 
-def download(camera_name, path, filename):
-    # the file is downloaded, the date is fetched and the file is stored into
-    # {_TEMP}/{date} {camera_name}/{filename}
-    file = f"{path}/{filename}"
-    directory = f"{_TEMP}"
-
-    try:
-        # download to {_TEMP}
-        os.makedirs(_TEMP + "/tmp", exist_ok=True)
-        filepath = f"{_TEMP}/tmp/{filename}"
-
-        logging.info(f"Going to copy {file}")
-        sleep = 1
-        for attempt in range(10):
-            try:
-                logging.info(f"Copying {file}")
-                shutil.copyfile(file, filepath)
-            except Exception as e:
-                time.sleep(sleep)  # pause hoping things will normalize
-                logging.warning(f"Sleeping {sleep} seconds because of error trying to copy {file} ({e}).")
-                sleep *= 2
-            else:
-                logging.info(f"Downloaded '{filepath}'")
-                break  # no error caught
-        else:
-            logging.critical(f"Retried 10 times copying {file}")
-        # fetch date
+def copy(source, destination, policy):
+    # copies inside the kernel, without passing the data through python:
+    # with copy_file_range, or with sendfile where that isn't supported
+    # (older kernels, some combinations of file systems); blocks of _CHUNK_SIZE
+    # are copied until it takes much longer than 'policy' expects
+    start = time.perf_counter()
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        deadline = policy.deadline(size)
+        copied = 0
         try:
-            f = open(filepath, 'rb')
-            tags = exifread.process_file(f)
-            datetime_tag = tags['EXIF DateTimeOriginal']
-            datetime_string = datetime_tag.values
-            datetime_object = datetime.datetime.strptime(datetime_string, '%Y:%m:%d %H:%M:%S')
-            date = datetime_object.strftime('%Y%m%d')
-            logging.info(f"Fetched the date from exif: '{date}'")
-        except Exception as e:
-            date = datetime.datetime.now().strftime('%Y%m%d')
-            logging.info(f"No date in exif, using today: '{date}'; because: {e}")
-        # move to album
-        album_directory = f"{_TEMP}/{date} {camera_name}"
-        os.makedirs(album_directory, exist_ok=True)
-        final_filepath = f"{album_directory}/{filename}"
-        os.replace(filepath, final_filepath)
-        logging.info(f"Moved '{filepath}' to '{final_filepath}'")
-        return True
-    except Exception as e:
-        logging.error(f"Error downloading '{filename}': {e}")
-        logging.error(traceback.format_exc())
-        return False
-
-
-
-def add_to_list_of_downloaded_files(camera_name, filename):
-    history_filename = f"{_HISTORY}/{camera_name}.txt"
-    try:
-        file = open(history_filename, "a")
-        file.write(f"{filename}\n")
-        file.close()
-        logging.info(f"Added '{filename}' to '{history_filename}'")
-    except Exception as e:
-        logging.error(f"Error adding '{filename}' to '{history_filename}': {e}")
+            try:
+                while copied < size:
+                    n = os.copy_file_range(src.fileno(), dst.fileno(), min(size - copied, _CHUNK_SIZE), copied, copied)
+                    if n == 0:
+                        break
+                    copied += n
+                    ezmetrics.add_bytes(n)
+                    if deadline and time.perf_counter() > deadline:
+                        raise Exception(f"Too slow, cut off after {copied} bytes")
+            except (AttributeError, OSError) as e:
+                logging.debug(f"Can't use copy_file_range for '{source}', using sendfile: {e}")
+                dst.seek(copied)
+                while copied < size:
+                    n = os.sendfile(dst.fileno(), src.fileno(), copied, min(size - copied, _CHUNK_SIZE))
+                    if n == 0:
+                        break
+                    copied += n
+                    ezmetrics.add_bytes(n)
+                    if deadline and time.perf_counter() > deadline:
+                        raise Exception(f"Too slow, cut off after {copied} bytes")
+        finally:
+            policy.measure(copied, time.perf_counter() - start)
+    if copied != size:
+        raise Exception(f"Copied {copied} of {size} bytes")
 
 
 def unmount(usb_path):
@@ -229,41 +273,5 @@ def unmount(usb_path):
     logging.info(f"Unmounted {usb_path}")
 
 
-def upload_to_photos(camera_name):
-
-    def _upload_to_photos():
-        import pdb;pdb.set_trace()
-        logging.info("Launching Photo Uploader...")
-        result = subprocess.run(["/home/vic/bin/gphotos-uploader-cli","push"], capture_output=True, text=True, env=dict(os.environ, GPHOTOS_CLI_TOKENSTORE_KEY=""))
-        out = result.stdout.split('\n')
-        for i in out:
-            if "0 with errors" in i:
-                logging.info("Pictures successfully uploaded to Google Photo's")
-                return True  # Success
-        else:
-            logging.error("Error uploading pictures to Google Photo's; here's Photo Uploader's output:")
-            for i in out:
-                logging.error(i)
-            return False  # Failure
-        
-    # check if there are files in the folder(s) for 'camera_name'
-    # if so, do an upload (this will upload other folders as well)
-    temp_dirs = os.listdir(_TEMP)
-    for temp_dir in temp_dirs:
-        if camera_name in temp_dir:
-        # return immedialely: all images are uploaded
-            return _upload_to_photos()
-    else:
-        logging.info("No pictures to upload")
-        return True
-
-
-def delete_files():
-    dirs = glob.glob(_TEMP + "/*")
-    for d in dirs:
-        shutil.rmtree(d)
-    logging.info(f"Deleted {len(dirs)} directories in {_TEMP}")
-
-
 if __name__ == "__main__":
     main()